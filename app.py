@@ -1,76 +1,649 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import (Flask, Response, g, render_template, request, redirect, url_for, session, flash, jsonify,
+                   send_file, stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
+import click
+import csv
+import heapq
+import hmac
+import json
 import os
+import queue
+import re
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from datetime import date
-from flask_admin import Admin
+from datetime import date, timedelta
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from functools import partial, wraps
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from flask_admin import Admin, BaseView, expose
+from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import DDL, and_, bindparam, event, func, inspect, insert, or_, select, true, tuple_, union_all
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from werkzeug.datastructures import CallbackDict
+from werkzeug.security import check_password_hash, generate_password_hash
+from wtforms.fields import DecimalField
+from wtforms.validators import DataRequired
 
 app = Flask(__name__, static_url_path='/static')
 app.config['SECRET_KEY'] = 'your_secret_key'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(os.getcwd(), 'users.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Wait for other writers instead of failing straight away when many bookings arrive at once
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
+# Default number of residents allowed per time slot for each facility
+app.config['FACILITY_CAPACITY'] = {'gym': 20, 'swimming_pool': 15}
+# Rules checked inside every booking: no two bookings of a resident may overlap in time, and a
+# unit may book at most max_per_week_per_unit slots per Monday-to-Sunday week (None for no limit)
+app.config['BOOKING_RULES'] = {'no_overlap': True, 'max_per_week_per_unit': 7}
+# Seconds a cached availability entry may live, only matters for changes made by other workers
+app.config['AVAILABILITY_CACHE_TTL'] = 60
+# Longest date range a single availability request may ask for
+app.config['AVAILABILITY_MAX_DAYS'] = 62
+# Seconds a place picked on the selection page is held for the resident before it is released
+app.config['HOLD_TTL_SECONDS'] = 300
+# Longest weekly repeat a resident can book in one go
+app.config['MAX_RECURRING_WEEKS'] = 12
+# Reservations shown per page of a resident's booking history
+app.config['HISTORY_PAGE_SIZE'] = 20
+# Fee rows shown per page of a resident's outstanding fee ledger
+app.config['LEDGER_PAGE_SIZE'] = 20
+# Reservations older than this many days are moved to the archive table
+app.config['ARCHIVE_HORIZON_DAYS'] = 90
+# Rows moved per archive transaction, keeps each write lock short
+app.config['ARCHIVE_BATCH_SIZE'] = 500
+# Hours between archive and prune runs inside the app, 0 leaves them to cron running 'flask
+# archive-reservations', 'flask prune-sessions' and 'flask prune-rate-limits'
+app.config['ARCHIVE_INTERVAL_HOURS'] = 24
+# Werkzeug hash method for passwords, scrypt:N:r:p sets the cost. Stored hashes made with a
+# different method are replaced with this one the next time their owner logs in.
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt:32768:8:1'
+# Threads that compute password hashes, and the seconds a login waits for one before giving up
+app.config['PASSWORD_HASH_WORKERS'] = os.cpu_count() or 2
+app.config['PASSWORD_HASH_TIMEOUT'] = 5
+# Sessions are kept in the user_session table, each worker caches up to SESSION_CACHE_SIZE of
+# them for SESSION_CACHE_TTL seconds, which is also how long a revoked session may still work
+# in another worker
+app.config['SESSION_CACHE_SIZE'] = 10000
+app.config['SESSION_CACHE_TTL'] = 30
+# Seconds a worker keeps a signed-in user's record, edits made in the same worker apply at once
+app.config['USER_CACHE_TTL'] = 300
+# Login and signup attempts allowed as (attempts, sliding window in seconds), counted per client
+# IP and per account name in a small SQLite file of their own that all workers share
+app.config['RATE_LIMIT_DB'] = os.path.join(os.getcwd(), 'ratelimit.db')
+app.config['RATE_LIMITS'] = {'login_ip': (30, 60), 'login_name': (10, 300), 'signup_ip': (5, 3600)}
+# Residents inserted per statement by the CSV importer, and processes hashing their passwords
+app.config['IMPORT_CHUNK_SIZE'] = 500
+app.config['IMPORT_HASH_WORKERS'] = os.cpu_count() or 2
+# Gateway charging card payments: 'fake' approves them in process (cards ending in 0002 are
+# declined), anything else is the base URL of an HTTP gateway offering /authorize and /capture
+app.config['PAYMENT_GATEWAY'] = 'fake'
+app.config['PAYMENT_GATEWAY_TIMEOUT'] = 10
+# Threads charging queued payment intents, and gateway attempts per intent while it is failing
+app.config['PAYMENT_WORKERS'] = 4
+app.config['PAYMENT_MAX_ATTEMPTS'] = 3
+# Seconds a worker's claim on an intent lasts. Only intents whose claim has run out are taken
+# over by another worker, so it must be longer than all gateway attempts of one intent take.
+app.config['PAYMENT_CLAIM_SECONDS'] = 300
+# Bank statement lines matched per batch by the reconciliation, and days a statement line's date
+# may be away from the date of the payment it matches
+app.config['RECONCILE_CHUNK_SIZE'] = 5000
+app.config['RECONCILE_DATE_WINDOW_DAYS'] = 3
+# Any setting above can be overridden from the environment, e.g. FLASK_PAYMENT_GATEWAY=http://127.0.0.1:8081
+app.config.from_prefixed_env()
 db = SQLAlchemy(app)
 admin = Admin(app, name='Admin', template_mode='bootstrap3')
 
+# Time slots residents can book for every facility, as (start, end) minutes after midnight
+TIME_SLOTS = [(8 * 60, 10 * 60), (13 * 60, 15 * 60), (18 * 60, 20 * 60), (21 * 60, 23 * 60)]
+SLOT_END_MINUTE = dict(TIME_SLOTS)
+
+# Format minutes after midnight as a 12-hour clock time such as 6:00 PM
+def format_minute(minute):
+    hour, minute = divmod(minute, 60)
+    return f"{(hour - 1) % 12 + 1}:{minute:02d} {'AM' if hour < 12 else 'PM'}"
+
+@app.template_global()
+def format_time_slot(start_minute, end_minute):
+    return f'{format_minute(start_minute)} - {format_minute(end_minute)}'
+
+
+# Thread-safe LRU cache whose entries expire after ttl seconds
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# Money is stored as whole cents in an INTEGER column and read back as a Decimal in ringgit,
+# so amounts and their SQL sums are exact
+class Cents(db.TypeDecorator):
+    impl = db.Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int((Decimal(str(value)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else Decimal(value).scaleb(-2)
+
 # Define User and Reservation models
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    # The old name is loaded before a rename so rename_user_rows can find the rows under it
+    name = db.column_property(db.Column(db.String(100), nullable=False, unique=True, index=True), active_history=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password = db.Column(db.String(80), nullable=False)
-    unit_number = db.Column(db.String(20), nullable=False)
+    password = db.Column(db.String(255), nullable=False)
+    unit_number = db.Column(db.String(20), nullable=False, unique=True, index=True)
+    calendar_token = db.Column(db.String(43), unique=True, index=True)
+    # Bumped whenever one of the user's reservations is edited in place, part of the calendar ETag
+    calendar_version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __str__(self):
+        return self.name
 
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    name = db.Column(db.String(100), nullable=False, index=True)
     payment_method = db.Column(db.String(20), nullable=False)
-    payment_amount = db.Column(db.Numeric(8, 2), nullable=False)
+    payment_amount = db.Column('amount_cents', Cents, nullable=False)
     payment_date = db.Column(db.Date, nullable=False)
+    # Set on rows made by the monthly invoice run, one per user, fee and period (YYYY-MM)
+    fee_code = db.Column(db.String(20))
+    period = db.Column(db.String(7))
+    # Gateway or bank reference of a receipt, bank statement lines are matched on it
+    reference = db.Column(db.String(64))
+    user = db.relationship(User)
+    __table_args__ = (
+        db.Index('ix_payment_user_date', 'user_id', 'payment_date', 'id'),
+        db.Index('ix_payment_invoice', 'user_id', 'fee_code', 'period', unique=True),
+        db.Index('ix_payment_date', 'payment_date', 'id'),
+        db.Index('ix_payment_reference', 'reference', unique=True),
+    )
+
+# Fees charged to every unit each month by the invoice run
+class FeeSchedule(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    fee_code = db.Column(db.String(20), nullable=False, unique=True)
+    description = db.Column(db.String(200), nullable=False)
+    amount = db.Column('amount_cents', Cents, nullable=False)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+
+# Sum of each user's payment rows, kept up to date by triggers on the payment table so every
+# insert, update and delete (ORM, admin or bulk SQL) changes it in the same transaction
+class ResidentBalance(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, autoincrement=False)
+    balance = db.Column('balance_cents', Cents, nullable=False, default=0)
+
+PAYMENT_BALANCE_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS payment_balance_insert AFTER INSERT ON payment WHEN NEW.user_id IS NOT NULL '
+    'BEGIN INSERT INTO resident_balance (user_id, balance_cents) VALUES (NEW.user_id, NEW.amount_cents) '
+    'ON CONFLICT (user_id) DO UPDATE SET balance_cents = balance_cents + excluded.balance_cents; END',
+    'CREATE TRIGGER IF NOT EXISTS payment_balance_delete AFTER DELETE ON payment WHEN OLD.user_id IS NOT NULL '
+    'BEGIN UPDATE resident_balance SET balance_cents = balance_cents - OLD.amount_cents '
+    'WHERE user_id = OLD.user_id; END',
+    'CREATE TRIGGER IF NOT EXISTS payment_balance_update AFTER UPDATE OF user_id, amount_cents ON payment '
+    'BEGIN UPDATE resident_balance SET balance_cents = balance_cents - OLD.amount_cents '
+    'WHERE user_id = OLD.user_id; '
+    'INSERT INTO resident_balance (user_id, balance_cents) SELECT NEW.user_id, NEW.amount_cents '
+    'WHERE NEW.user_id IS NOT NULL '
+    'ON CONFLICT (user_id) DO UPDATE SET balance_cents = balance_cents + excluded.balance_cents; END',
+]
+
+for trigger in PAYMENT_BALANCE_TRIGGERS:
+    event.listen(Payment.__table__, 'after_create', DDL(trigger))
+
+# A resident's request to pay, keyed by the idempotency key their payment form was issued.
+# Only the last four card digits are kept, as the source passed to the gateway.
+class PaymentIntent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    idempotency_key = db.Column(db.String(64), nullable=False)
+    amount = db.Column('amount_cents', Cents, nullable=False)
+    method = db.Column(db.String(20), nullable=False)
+    source = db.Column(db.String(40), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    gateway_reference = db.Column(db.String(64))
+    error = db.Column(db.String(200))
+    payment_id = db.Column(db.Integer, db.ForeignKey('payment.id'))
+    # The worker charging the intent and when it claimed it, see process_payment_intent
+    claim_token = db.Column(db.String(32))
+    claimed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    user = db.relationship(User)
+    __table_args__ = (
+        db.Index('ix_payment_intent_key', 'user_id', 'idempotency_key', unique=True),
+        db.Index('ix_payment_intent_status', 'status'),
+        db.Index('ix_payment_intent_payment', 'payment_id', unique=True),
+    )
+
+# One bank statement reconciled against the payment table, with the counts of its outcome
+class ReconciliationRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    lines = db.Column(db.Integer, nullable=False, default=0)
+    matched = db.Column(db.Integer, nullable=False, default=0)
+    discrepancies = db.Column(db.Integer, nullable=False, default=0)
+
+    def __str__(self):
+        return f'#{self.id} {self.filename}'
+
+# Outcome of one statement line: matched, mismatch (its reference names a payment whose amount
+# or date differ), unmatched (no payment found) or invalid (the line could not be read). Receipts
+# of the statement period that no line accounts for are added as missing, without line details.
+class ReconciliationLine(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('reconciliation_run.id'), nullable=False)
+    line_number = db.Column(db.Integer)
+    statement_date = db.Column(db.Date)
+    amount = db.Column('amount_cents', Cents)
+    reference = db.Column(db.String(64))
+    description = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False)
+    payment_id = db.Column(db.Integer, db.ForeignKey('payment.id'))
+    note = db.Column(db.String(200))
+    run = db.relationship(ReconciliationRun)
+    payment = db.relationship(Payment)
+    __table_args__ = (
+        db.Index('ix_reconciliation_line_run_status', 'run_id', 'status', 'id'),
+    )
 
 class Reservation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    username = db.Column(db.String(100), nullable=False)
+    location = db.Column(db.String(20), nullable=False)
+    selected_date = db.Column(db.Date, nullable=False)
+    start_minute = db.Column(db.Integer, nullable=False)
+    end_minute = db.Column(db.Integer, nullable=False)
+    user = db.relationship(User)
+    __table_args__ = (
+        db.Index('ix_reservation_user_id', 'user_id', 'id'),
+        db.Index('ix_reservation_username_id', 'username', 'id'),
+        db.Index('ix_reservation_username_date', 'username', 'selected_date', 'id'),
+        db.Index('ix_reservation_slot', 'location', 'selected_date', 'start_minute'),
+        db.Index('ix_reservation_selected_date', 'selected_date'),
+        # Ids are never reused, so they stay unique across reservation and reservation_archive
+        {'sqlite_autoincrement': True},
+    )
+
+    @property
+    def selected_time(self):
+        return format_time_slot(self.start_minute, self.end_minute)
+
+# Past reservations moved out of the hot reservation table, ids are kept from the original rows
+class ReservationArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    username = db.Column(db.String(100), nullable=False)
+    location = db.Column(db.String(20), nullable=False)
+    selected_date = db.Column(db.Date, nullable=False)
+    start_minute = db.Column(db.Integer, nullable=False)
+    end_minute = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False)
+    user = db.relationship(User)
+    __table_args__ = (
+        db.Index('ix_reservation_archive_username_date', 'username', 'selected_date', 'id'),
+        db.Index('ix_reservation_archive_user_id', 'user_id', 'id'),
+    )
+
+    @property
+    def selected_time(self):
+        return format_time_slot(self.start_minute, self.end_minute)
+
+# Booked places per slot and day, kept up to date by every booking and cancellation so
+# utilization reports never have to aggregate the reservation table
+class OccupancyDaily(db.Model):
+    location = db.Column(db.String(20), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    start_minute = db.Column(db.Integer, primary_key=True)
+    booked = db.Column(db.Integer, nullable=False, default=0)
+
+# Per-slot capacity overrides, slots without a row use FACILITY_CAPACITY
+class SlotCapacity(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    location = db.Column(db.String(20), nullable=False)
+    selected_date = db.Column(db.Date, nullable=False)
+    start_minute = db.Column(db.Integer, nullable=False)
+    capacity = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.UniqueConstraint('location', 'selected_date', 'start_minute'),)
+
+# Residents waiting for a place in a full slot, served in position order
+class WaitlistEntry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), nullable=False)
     location = db.Column(db.String(20), nullable=False)
     selected_date = db.Column(db.Date, nullable=False)
-    selected_time = db.Column(db.String(50), nullable=False)
+    start_minute = db.Column(db.Integer, nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    __table_args__ = (db.Index('ix_waitlist_slot', 'location', 'selected_date', 'start_minute', 'position'),)
+
+# A place set aside for a resident while they confirm, counted against capacity until expires_at
+class SlotHold(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(64), nullable=False, unique=True)
+    username = db.Column(db.String(100), nullable=False, index=True)
+    location = db.Column(db.String(20), nullable=False)
+    selected_date = db.Column(db.Date, nullable=False)
+    start_minute = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    __table_args__ = (db.Index('ix_slot_hold_slot', 'location', 'selected_date', 'start_minute', 'expires_at'),)
+
+# Messages shown to a resident the next time they open the menu
+class Notification(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(100), nullable=False)
+    message = db.Column(db.String(500), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    is_read = db.Column(db.Boolean, nullable=False, default=False)
+    __table_args__ = (db.Index('ix_notification_username_read', 'username', 'is_read'),)
+
+class UserSession(db.Model):
+    id = db.Column(db.String(43), primary_key=True)
+    user_id = db.Column(db.Integer, index=True)
+    data = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    revoked = db.Column(db.Boolean, nullable=False, default=False)
 
 class Announcement(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     announcement_title = db.Column(db.String(200), nullable=False)
-    announcement_date = db.Column(db.Date, nullable=False)
+    announcement_date = db.Column(db.Date, nullable=False, index=True)
     announcement_detail = db.Column(db.String(1000), nullable=False)
 
 # Create a subclass of the ModelView class for the User model (admin)
 class UserView(ModelView):
-    column_list = ('name', 'email', 'password', 'unit_number')
+    column_list = ('name', 'email', 'unit_number')
     column_searchable_list = ('name', 'email')
-    column_editable_list = ('password', 'unit_number')
+    column_editable_list = ('unit_number',)
     form_columns = ('name', 'email', 'password', 'unit_number')
 
+    # A password typed into the form is stored hashed, an unchanged hash is kept as it is
+    def on_model_change(self, form, model, is_created):
+        if model.password and not is_password_hash(model.password):
+            model.password = hash_password(model.password)
+
 # Add the view to the admin instance (admin)
 admin.add_view(UserView(User, db.session, name='Users'))
 
 # Create a subclass of the ModelView class for the Payment model (admin)
 class PaymentView(ModelView):
-    column_list = ('name', 'payment_method', 'payment_amount', 'payment_date')
-    column_searchable_list = ('name',)
+    column_list = ('user', 'payment_method', 'payment_amount', 'payment_date', 'reference')
+    column_searchable_list = ('user.name', 'reference')
     column_filters = ('payment_method', 'payment_date')
-    form_columns = ('name', 'payment_method', 'payment_amount', 'payment_date')
+    form_columns = ('user', 'payment_method', 'payment_amount', 'payment_date', 'reference')
+    column_labels = {'user': 'Name', 'user.name': 'Name'}
+    form_overrides = {'payment_amount': DecimalField}
+    form_args = {'user': {'validators': [DataRequired()]}, 'payment_amount': {'places': 2}}
+
+    # The name column is kept for older reports, it always follows the linked user
+    def on_model_change(self, form, model, is_created):
+        model.name = model.user.name
 
 # Add the Payment view to the admin instance
 admin.add_view(PaymentView(Payment, db.session, name='Payments'))
 
+# Create a subclass of the ModelView class for the PaymentIntent model (admin), intents are read-only
+class PaymentIntentView(ModelView):
+    column_list = ('user', 'amount', 'method', 'source', 'status', 'gateway_reference', 'error', 'created_at')
+    column_filters = ('status', 'method', 'created_at')
+    column_default_sort = ('created_at', True)
+    column_labels = {'user': 'Name'}
+    can_create = False
+    can_edit = False
+    can_delete = False
+
+# Add the PaymentIntent view to the admin instance
+admin.add_view(PaymentIntentView(PaymentIntent, db.session, name='Payment Intents'))
+
+# Create a subclass of the ModelView class for the FeeSchedule model (admin)
+class FeeScheduleView(ModelView):
+    column_list = ('fee_code', 'description', 'amount', 'active')
+    form_columns = ('fee_code', 'description', 'amount', 'active')
+    form_overrides = {'amount': DecimalField}
+    form_args = {'amount': {'places': 2}}
+
+# Add the FeeSchedule view to the admin instance
+admin.add_view(FeeScheduleView(FeeSchedule, db.session, name='Fee Schedule'))
+
+# Run the monthly invoices for a period from the admin, rerunning a period adds nothing twice
+class InvoiceRunView(BaseView):
+    @expose('/', methods=['GET', 'POST'])
+    def index(self):
+        if request.method == 'POST':
+            period = parse_billing_period(request.form.get('period'))
+            if period is None:
+                flash('Enter the period as YYYY-MM.', 'error')
+            else:
+                flash(f'{generate_invoices(period)} invoices created for {period}.')
+            return redirect(url_for('.index'))
+        return self.render('admin/invoices.html', period=date.today().strftime('%Y-%m'),
+                           fees=FeeSchedule.query.filter_by(active=True).order_by(FeeSchedule.fee_code).all())
+
+# Add the Invoices page to the admin instance
+admin.add_view(InvoiceRunView(name='Invoices', endpoint='invoices'))
+
+# Upload a bank statement CSV, it is reconciled in the background and this page shows its
+# progress, the earlier runs and their discrepancy reports
+class ReconciliationView(BaseView):
+    @expose('/', methods=['GET', 'POST'])
+    def index(self):
+        if request.method == 'POST':
+            upload = request.files.get('file')
+            if not upload or not upload.filename:
+                flash('Choose a statement CSV to reconcile.', 'error')
+                return redirect(url_for('.index'))
+            return redirect(url_for('.index', run=start_reconciliation(upload)))
+        run_id = request.args.get('run', type=int)
+        runs = ReconciliationRun.query.order_by(ReconciliationRun.id.desc()).limit(20).all()
+        return self.render('admin/reconciliation.html', run_id=run_id, job=reconciliations.get(run_id), runs=runs,
+                           fields=STATEMENT_CSV_FIELDS, window=app.config['RECONCILE_DATE_WINDOW_DAYS'])
+
+    @expose('/report/<int:run_id>')
+    def report(self, run_id):
+        response = Response(stream_with_context(reconciliation_report_lines(run_id)), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f'attachment; filename=discrepancies_{run_id}.csv'
+        return response
+
+# Add the Reconciliation page to the admin instance
+admin.add_view(ReconciliationView(name='Reconciliation', endpoint='reconciliation'))
+
+# Create a subclass of the ModelView class for the ReconciliationLine model (admin), results are read-only
+class ReconciliationLineView(ModelView):
+    column_list = ('run', 'line_number', 'statement_date', 'amount', 'reference', 'status', 'payment', 'note')
+    column_searchable_list = ('reference', 'description')
+    column_filters = ('run_id', 'status', 'statement_date')
+    column_labels = {'run': 'Run', 'run_id': 'Run', 'payment': 'Payment'}
+    can_create = False
+    can_edit = False
+    can_delete = False
+
+# Add the ReconciliationLine view to the admin instance
+admin.add_view(ReconciliationLineView(ReconciliationLine, db.session, name='Statement Lines'))
+
 # Create a subclass of the ModelView class for the Reservation model (admin)
 class ReservationView(ModelView):
-    column_list = ('username', 'location', 'selected_date', 'selected_time')
-    column_searchable_list = ('username', 'location')
-    column_filters = ('selected_date', 'selected_time')
-    form_columns = ('username', 'location', 'selected_date', 'selected_time')
+    column_list = ('user', 'location', 'selected_date', 'selected_time')
+    column_searchable_list = ('user.name', 'location')
+    column_filters = ('selected_date', 'start_minute')
+    form_columns = ('user', 'location', 'selected_date', 'start_minute', 'end_minute')
+    column_labels = {'user': 'Username', 'user.name': 'Username',
+                     'start_minute': 'Start (minutes after midnight)', 'end_minute': 'End (minutes after midnight)'}
+    form_args = {'user': {'validators': [DataRequired()]}}
+
+    def on_model_change(self, form, model, is_created):
+        model.username = model.user.name
 
 # Add the Reservation view to the admin instance
 admin.add_view(ReservationView(Reservation, db.session, name='Reservations'))
 
+# Create a subclass of the ModelView class for the ReservationArchive model (admin), archived rows are read-only
+class ReservationArchiveView(ModelView):
+    column_list = ('user', 'location', 'selected_date', 'selected_time', 'archived_at')
+    column_searchable_list = ('user.name', 'location')
+    column_labels = {'user': 'Username', 'user.name': 'Username'}
+    column_filters = ('selected_date',)
+    can_create = False
+    can_edit = False
+
+# Add the ReservationArchive view to the admin instance
+admin.add_view(ReservationArchiveView(ReservationArchive, db.session, name='Archived Reservations'))
+
+# Create a subclass of the ModelView class for the SlotCapacity model (admin)
+class SlotCapacityView(ModelView):
+    column_list = ('location', 'selected_date', 'start_minute', 'capacity')
+    column_filters = ('location', 'selected_date')
+    form_columns = ('location', 'selected_date', 'start_minute', 'capacity')
+    column_labels = {'start_minute': 'Start (minutes after midnight)'}
+
+# Add the SlotCapacity view to the admin instance
+admin.add_view(SlotCapacityView(SlotCapacity, db.session, name='Slot Capacity'))
+
+# Create a subclass of the ModelView class for the WaitlistEntry model (admin)
+class WaitlistView(ModelView):
+    column_list = ('username', 'location', 'selected_date', 'start_minute', 'position', 'created_at')
+    column_filters = ('location', 'selected_date')
+    column_default_sort = ('position', False)
+    can_create = False
+
+# Add the Waitlist view to the admin instance
+admin.add_view(WaitlistView(WaitlistEntry, db.session, name='Waitlist'))
+
+# Create a subclass of the ModelView class for the UserSession model, sessions can only be revoked (admin)
+class UserSessionView(ModelView):
+    column_list = ('user_id', 'created_at', 'expires_at', 'revoked')
+    column_filters = ('user_id', 'revoked')
+    column_default_sort = ('created_at', True)
+    can_create = False
+    can_edit = False
+
+    @action('revoke', 'Revoke', 'Sign out the selected sessions?')
+    def action_revoke(self, ids):
+        flash(f'{session_store.revoke(ids)} sessions revoked.')
+
+# Add the Sessions view to the admin instance
+admin.add_view(UserSessionView(UserSession, db.session, name='Sessions'))
+
+# Utilization heatmap (weekday by time slot) for each facility, read only from occupancy_daily
+class OccupancyDashboardView(BaseView):
+    @expose('/')
+    def index(self):
+        locations = list(app.config['FACILITY_CAPACITY'])
+        location = request.args.get('location')
+        if location not in locations:
+            location = locations[0]
+        try:
+            end = datetime.strptime(request.args['to'], '%Y-%m-%d').date()
+        except (KeyError, ValueError):
+            end = date.today()
+        try:
+            start = datetime.strptime(request.args['from'], '%Y-%m-%d').date()
+        except (KeyError, ValueError):
+            start = end - timedelta(weeks=8) + timedelta(days=1)
+
+        weekday = func.cast(func.strftime('%w', OccupancyDaily.day), db.Integer)
+        booked = {
+            ((row.weekday + 6) % 7, row.start_minute): row.booked
+            for row in db.session.execute(
+                select(weekday.label('weekday'), OccupancyDaily.start_minute, func.sum(OccupancyDaily.booked).label('booked'))
+                .where(OccupancyDaily.location == location, OccupancyDaily.day.between(start, end))
+                .group_by(weekday, OccupancyDaily.start_minute)
+            )
+        }
+
+        # Utilization of each weekday and slot: places booked over places offered on the days of
+        # that weekday in the range, counting each day's capacity override where there is one
+        default_capacity = app.config['FACILITY_CAPACITY'][location]
+        overrides = slot_capacities(location, start, end)
+        capacity = {}
+        for offset in range((end - start).days + 1):
+            day = start + timedelta(days=offset)
+            for start_minute, _ in TIME_SLOTS:
+                key = (day.weekday(), start_minute)
+                capacity[key] = capacity.get(key, 0) + overrides.get((day, start_minute), default_capacity)
+        heatmap = [
+            [booked.get((day, start_minute), 0) / capacity[day, start_minute]
+             if capacity.get((day, start_minute)) else 0
+             for day in range(7)]
+            for start_minute, _ in TIME_SLOTS
+        ]
+        return self.render('admin/occupancy.html', locations=locations, location=location, start=start, end=end,
+                           time_slots=TIME_SLOTS, heatmap=heatmap)
+
+# Add the Occupancy dashboard to the admin instance
+admin.add_view(OccupancyDashboardView(name='Occupancy', endpoint='occupancy'))
+
+# Upload a residents CSV, the import runs in the background and this page shows its progress
+class ResidentImportView(BaseView):
+    @expose('/', methods=['GET', 'POST'])
+    def index(self):
+        if request.method == 'POST':
+            upload = request.files.get('file')
+            if not upload or not upload.filename:
+                flash('Choose a CSV file to import.', 'error')
+                return redirect(url_for('.index'))
+            return redirect(url_for('.index', job=start_resident_import(upload)))
+        job_id = request.args.get('job')
+        return self.render('admin/resident_import.html', job_id=job_id, job=resident_imports.get(job_id),
+                           fields=RESIDENT_CSV_FIELDS)
+
+    @expose('/errors/<job_id>')
+    def errors(self, job_id):
+        job = resident_imports.get(job_id)
+        if job is None:
+            return redirect(url_for('.index'))
+        return send_file(job['error_path'], mimetype='text/csv', as_attachment=True,
+                         download_name='rejected_residents.csv')
+
+# Add the Import Residents page to the admin instance
+admin.add_view(ResidentImportView(name='Import Residents', endpoint='resident_import'))
+
 # Create a subclass of the ModelView class for the Announcement model (admin)
 class AnnouncementView(ModelView):
     column_list = ('announcement_title', 'announcement_date', 'announcement_detail')
@@ -81,16 +654,2138 @@ class AnnouncementView(ModelView):
 # Add the Announcement view to the admin instance
 admin.add_view(AnnouncementView(Announcement, db.session, name='Announcements'))
 
-# Create all tables within app context
+# Schema migrations for databases created by older versions of the app. The applied
+# version is kept in SQLite's user_version pragma. Every migration lists the route
+# queries it speeds up together with the index EXPLAIN QUERY PLAN must report for them.
+# Migrations run before create_all(), so tables added after the database was created
+# may not exist yet and are simply created from the current models afterwards.
+MIGRATIONS = []
+
+def migration(version, query_plans=()):
+    def register(upgrade):
+        MIGRATIONS.append((version, upgrade, query_plans))
+        return upgrade
+    return register
+
+def schema_version():
+    return max(version for version, _, _ in MIGRATIONS)
+
+def check_query_plans(connection, query_plans):
+    for query, index_name in query_plans:
+        plan = ' | '.join(row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + query))
+        if index_name not in plan:
+            raise RuntimeError(f'Query does not use {index_name}: {query} ({plan})')
+
+# Apply pending migrations in one transaction, BEGIN IMMEDIATE keeps two workers
+# starting at the same time from upgrading the same file twice
+def upgrade_database():
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+        version = connection.exec_driver_sql('PRAGMA user_version').scalar()
+        for target, upgrade, query_plans in sorted(MIGRATIONS, key=lambda item: item[0]):
+            if target <= version:
+                continue
+            upgrade(connection)
+            check_query_plans(connection, query_plans)
+            connection.exec_driver_sql(f'PRAGMA user_version = {target}')
+        connection.commit()
+
+# A database created from the current models is already at the newest version
+def stamp_database():
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql(f'PRAGMA user_version = {schema_version()}')
+        connection.commit()
+
+@migration(1, query_plans=[
+    ("SELECT * FROM reservation WHERE username = 'resident' ORDER BY id DESC LIMIT 1",
+     'ix_reservation_username_id'),
+    ("SELECT count(id) FROM reservation WHERE location = 'gym' AND selected_date = '2024-01-01' "
+     "AND selected_time = '6:00 PM - 8:00 PM'",
+     'ix_reservation_slot'),
+    ("SELECT * FROM payment WHERE name = 'resident'", 'ix_payment_name'),
+    ("SELECT * FROM announcement ORDER BY announcement_date DESC", 'ix_announcement_announcement_date'),
+])
+def add_hot_path_indexes(connection):
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_reservation_username_id ON reservation (username, id)')
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS ix_reservation_slot ON reservation (location, selected_date, selected_time)')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_payment_name ON payment (name)')
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS ix_announcement_announcement_date ON announcement (announcement_date)')
+
+# Parse display text such as "6:00 PM - 8:00 PM" into (start, end) minutes after midnight
+TIME_SLOT_PATTERN = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*([AP]M)\s*-\s*(\d{1,2}):(\d{2})\s*([AP]M)\s*$', re.IGNORECASE)
+
+def parse_time_slot(text):
+    match = TIME_SLOT_PATTERN.match(text)
+    if not match:
+        raise ValueError(f'Unrecognised time slot: {text!r}')
+    minutes = []
+    for hour, minute, meridiem in (match.group(1, 2, 3), match.group(4, 5, 6)):
+        minutes.append((int(hour) % 12 + (12 if meridiem.upper() == 'PM' else 0)) * 60 + int(minute))
+    return tuple(minutes)
+
+@migration(2, query_plans=[
+    ("SELECT count(id) FROM reservation WHERE location = 'gym' AND selected_date = '2024-01-01' "
+     "AND start_minute = 1080",
+     'ix_reservation_slot'),
+    ("SELECT selected_date, start_minute, count(id) FROM reservation WHERE location = 'gym' "
+     "AND selected_date BETWEEN '2024-01-01' AND '2024-01-31' GROUP BY selected_date, start_minute",
+     'ix_reservation_slot'),
+])
+def convert_selected_time_to_minutes(connection):
+    # Translate every distinct label once, then rebuild the tables set-wise through a join
+    has_slot_capacity = inspect(connection).has_table('slot_capacity')
+    labels = {row[0] for row in connection.exec_driver_sql('SELECT DISTINCT selected_time FROM reservation')}
+    if has_slot_capacity:
+        labels |= {row[0] for row in connection.exec_driver_sql('SELECT DISTINCT selected_time FROM slot_capacity')}
+    connection.exec_driver_sql(
+        'CREATE TEMP TABLE time_slot_label (label VARCHAR(50) PRIMARY KEY, start_minute INTEGER, end_minute INTEGER)')
+    if labels:
+        connection.exec_driver_sql(
+            'INSERT INTO time_slot_label VALUES (?, ?, ?)',
+            [(label,) + parse_time_slot(label) for label in labels])
+
+    connection.exec_driver_sql(
+        'CREATE TABLE reservation_new (id INTEGER NOT NULL, username VARCHAR(100) NOT NULL, '
+        'location VARCHAR(20) NOT NULL, selected_date DATE NOT NULL, start_minute INTEGER NOT NULL, '
+        'end_minute INTEGER NOT NULL, PRIMARY KEY (id))')
+    connection.exec_driver_sql(
+        'INSERT INTO reservation_new SELECT r.id, r.username, r.location, r.selected_date, l.start_minute, l.end_minute '
+        'FROM reservation r JOIN time_slot_label l ON l.label = r.selected_time')
+    connection.exec_driver_sql('DROP TABLE reservation')
+    connection.exec_driver_sql('ALTER TABLE reservation_new RENAME TO reservation')
+    connection.exec_driver_sql('CREATE INDEX ix_reservation_username_id ON reservation (username, id)')
+    connection.exec_driver_sql('CREATE INDEX ix_reservation_slot ON reservation (location, selected_date, start_minute)')
+
+    if has_slot_capacity:
+        rebuild_slot_capacity(connection)
+    connection.exec_driver_sql('DROP TABLE time_slot_label')
+
+def rebuild_slot_capacity(connection):
+    connection.exec_driver_sql(
+        'CREATE TABLE slot_capacity_new (id INTEGER NOT NULL, location VARCHAR(20) NOT NULL, '
+        'selected_date DATE NOT NULL, start_minute INTEGER NOT NULL, capacity INTEGER NOT NULL, '
+        'PRIMARY KEY (id), UNIQUE (location, selected_date, start_minute))')
+    connection.exec_driver_sql(
+        'INSERT INTO slot_capacity_new SELECT c.id, c.location, c.selected_date, l.start_minute, c.capacity '
+        'FROM slot_capacity c JOIN time_slot_label l ON l.label = c.selected_time')
+    connection.exec_driver_sql('DROP TABLE slot_capacity')
+    connection.exec_driver_sql('ALTER TABLE slot_capacity_new RENAME TO slot_capacity')
+
+@migration(3, query_plans=[
+    ("SELECT * FROM reservation WHERE username = 'resident' AND (selected_date, id) > ('2024-01-01', 0) "
+     "ORDER BY selected_date, id LIMIT 21",
+     'ix_reservation_username_date'),
+    ("SELECT * FROM reservation WHERE username = 'resident' AND (selected_date, id) < ('2024-01-01', 0) "
+     "ORDER BY selected_date DESC, id DESC LIMIT 21",
+     'ix_reservation_username_date'),
+])
+def add_reservation_history_index(connection):
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS ix_reservation_username_date ON reservation (username, selected_date, id)')
+
+@migration(4, query_plans=[
+    ("SELECT id FROM reservation WHERE selected_date < '2024-01-01' ORDER BY selected_date, id LIMIT 500",
+     'ix_reservation_selected_date'),
+])
+def add_reservation_archive_support(connection):
+    # Rebuild with AUTOINCREMENT so ids of archived rows are never handed out again
+    connection.exec_driver_sql(
+        'CREATE TABLE reservation_new (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, username VARCHAR(100) NOT NULL, '
+        'location VARCHAR(20) NOT NULL, selected_date DATE NOT NULL, start_minute INTEGER NOT NULL, '
+        'end_minute INTEGER NOT NULL)')
+    connection.exec_driver_sql('INSERT INTO reservation_new SELECT id, username, location, selected_date, '
+                               'start_minute, end_minute FROM reservation')
+    connection.exec_driver_sql('DROP TABLE reservation')
+    connection.exec_driver_sql('ALTER TABLE reservation_new RENAME TO reservation')
+    connection.exec_driver_sql('CREATE INDEX ix_reservation_username_id ON reservation (username, id)')
+    connection.exec_driver_sql('CREATE INDEX ix_reservation_username_date ON reservation (username, selected_date, id)')
+    connection.exec_driver_sql('CREATE INDEX ix_reservation_slot ON reservation (location, selected_date, start_minute)')
+    connection.exec_driver_sql('CREATE INDEX ix_reservation_selected_date ON reservation (selected_date)')
+
+@migration(5, query_plans=[
+    ("SELECT 1 FROM reservation WHERE username = 'resident' AND selected_date = '2024-01-01' "
+     "AND start_minute < 1200 AND end_minute > 1080",
+     'ix_reservation_username_date'),
+    ("SELECT count(id) FROM reservation WHERE username IN (SELECT name FROM user WHERE unit_number = "
+     "(SELECT unit_number FROM user WHERE name = 'resident')) AND selected_date BETWEEN '2024-01-01' AND '2024-01-07'",
+     'ix_reservation_username_date'),
+    ("SELECT name FROM user WHERE unit_number = 'A12'", 'ix_user_unit_number'),
+    ("SELECT unit_number FROM user WHERE name = 'resident'", 'ix_user_name'),
+])
+def add_booking_rule_indexes(connection):
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_user_name ON user (name)')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_user_unit_number ON user (unit_number)')
+
+@migration(6)
+def add_occupancy_rollup(connection):
+    connection.exec_driver_sql(
+        'CREATE TABLE IF NOT EXISTS occupancy_daily (location VARCHAR(20) NOT NULL, day DATE NOT NULL, '
+        'start_minute INTEGER NOT NULL, booked INTEGER NOT NULL, PRIMARY KEY (location, day, start_minute))')
+    sources = ['SELECT location, selected_date, start_minute FROM reservation']
+    if inspect(connection).has_table('reservation_archive'):
+        sources.append('SELECT location, selected_date, start_minute FROM reservation_archive')
+    connection.exec_driver_sql(
+        'INSERT OR REPLACE INTO occupancy_daily (location, day, start_minute, booked) '
+        'SELECT location, selected_date, start_minute, count(*) FROM (' + ' UNION ALL '.join(sources) + ') '
+        'GROUP BY location, selected_date, start_minute')
+
+@migration(7, query_plans=[
+    ("SELECT name FROM user WHERE calendar_token = 'token'", 'ix_user_calendar_token'),
+    ("SELECT max(id), count(id) FROM reservation WHERE username = 'resident'", 'COVERING INDEX ix_reservation_username'),
+])
+def add_calendar_tokens(connection):
+    connection.exec_driver_sql('ALTER TABLE user ADD COLUMN calendar_token VARCHAR(43)')
+    connection.exec_driver_sql('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_calendar_token ON user (calendar_token)')
+
+# Names and unit numbers become unique. Duplicates already in the table stop the upgrade,
+# they have to be merged or renamed by hand before the indexes can be rebuilt.
+@migration(8, query_plans=[
+    ("SELECT id FROM user WHERE name = 'resident'", 'ix_user_name'),
+    ("SELECT id FROM user WHERE unit_number = 'A12'", 'ix_user_unit_number'),
+])
+def make_user_name_and_unit_unique(connection):
+    for column in ('name', 'unit_number'):
+        duplicates = connection.exec_driver_sql(
+            f'SELECT {column} FROM user GROUP BY {column} HAVING count(*) > 1').scalars().all()
+        if duplicates:
+            raise RuntimeError(f'Users share a {column}, fix these before upgrading: {duplicates}')
+        connection.exec_driver_sql(f'DROP INDEX IF EXISTS ix_user_{column}')
+        connection.exec_driver_sql(f'CREATE UNIQUE INDEX ix_user_{column} ON user ({column})')
+
+@migration(9, query_plans=[
+    ("SELECT id FROM payment WHERE name = 'resident' AND (payment_date, id) > ('2024-01-01', 1) "
+     "ORDER BY payment_date, id", 'ix_payment_name_date'),
+])
+def add_payment_ledger_index(connection):
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_payment_name_date ON payment (name, payment_date, id)')
+
+# Link payments and reservations to their user by id instead of by name. Rows whose name
+# matches no user keep a NULL user_id.
+@migration(10, query_plans=[
+    ("SELECT id FROM payment WHERE user_id = 1 AND (payment_date, id) > ('2024-01-01', 1) "
+     "ORDER BY payment_date, id", 'ix_payment_user_date'),
+    ("SELECT id FROM reservation WHERE user_id = 1 ORDER BY id DESC LIMIT 1", 'ix_reservation_user_id'),
+])
+def add_user_foreign_keys(connection):
+    for table, name_column in (('payment', 'name'), ('reservation', 'username'), ('reservation_archive', 'username')):
+        if not inspect(connection).has_table(table):
+            continue
+        connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN user_id INTEGER REFERENCES user (id)')
+        connection.exec_driver_sql(
+            f'UPDATE {table} SET user_id = (SELECT id FROM user WHERE user.name = {table}.{name_column})')
+    connection.exec_driver_sql('DROP INDEX IF EXISTS ix_payment_name_date')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_payment_user_date ON payment (user_id, payment_date, id)')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_reservation_user_id ON reservation (user_id, id)')
+    if inspect(connection).has_table('reservation_archive'):
+        connection.exec_driver_sql(
+            'CREATE INDEX IF NOT EXISTS ix_reservation_archive_user_id ON reservation_archive (user_id, id)')
+
+# Invoices are created with an upsert that skips (user_id, fee_code, period) already billed,
+# the conflict check is a lookup on the unique invoice key
+@migration(11, query_plans=[
+    ("SELECT id FROM payment WHERE user_id = 1 AND fee_code = 'maintenance' AND period = '2024-01'",
+     'ix_payment_invoice'),
+])
+def add_payment_invoice_key(connection):
+    connection.exec_driver_sql('ALTER TABLE payment ADD COLUMN fee_code VARCHAR(20)')
+    connection.exec_driver_sql('ALTER TABLE payment ADD COLUMN period VARCHAR(7)')
+    connection.exec_driver_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_payment_invoice ON payment (user_id, fee_code, period)')
+
+# Amounts move from NUMERIC (stored as floats by SQLite) to integer cents, and the balance
+# table is filled from the existing payments before its triggers take over
+@migration(12)
+def store_money_as_cents(connection):
+    for table, column in (('payment', 'payment_amount'), ('fee_schedule', 'amount')):
+        if not inspect(connection).has_table(table):
+            continue
+        connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN amount_cents INTEGER NOT NULL DEFAULT 0')
+        connection.exec_driver_sql(f'UPDATE {table} SET amount_cents = CAST(round({column} * 100) AS INTEGER)')
+        connection.exec_driver_sql(f'ALTER TABLE {table} DROP COLUMN {column}')
+    connection.exec_driver_sql(
+        'CREATE TABLE IF NOT EXISTS resident_balance (user_id INTEGER NOT NULL PRIMARY KEY REFERENCES user (id), '
+        'balance_cents INTEGER NOT NULL)')
+    connection.exec_driver_sql(
+        'INSERT OR REPLACE INTO resident_balance (user_id, balance_cents) '
+        'SELECT user_id, sum(amount_cents) FROM payment WHERE user_id IS NOT NULL GROUP BY user_id')
+    for trigger in PAYMENT_BALANCE_TRIGGERS:
+        connection.exec_driver_sql(trigger)
+
+# Receipts get the reference their gateway returned, and indexes for matching bank statement
+# lines to them by date range and by reference
+@migration(13, query_plans=[
+    ("SELECT id FROM payment WHERE payment_date BETWEEN '2024-01-01' AND '2024-01-31' AND amount_cents < 0",
+     'ix_payment_date'),
+    ("SELECT id FROM payment WHERE reference IN ('auth_1', 'auth_2')", 'ix_payment_reference'),
+])
+def add_payment_reference(connection):
+    connection.exec_driver_sql('ALTER TABLE payment ADD COLUMN reference VARCHAR(64)')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_payment_date ON payment (payment_date, id)')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_payment_reference ON payment (reference)')
+    if inspect(connection).has_table('payment_intent'):
+        connection.exec_driver_sql(
+            'UPDATE payment SET reference = (SELECT gateway_reference FROM payment_intent '
+            'WHERE payment_intent.payment_id = payment.id) '
+            'WHERE id IN (SELECT payment_id FROM payment_intent WHERE payment_id IS NOT NULL)')
+
+@migration(14)
+def add_calendar_versions(connection):
+    connection.exec_driver_sql('ALTER TABLE user ADD COLUMN calendar_version INTEGER NOT NULL DEFAULT 0')
+
+# Payment intents are claimed under a token with a lease, and a gateway reference or an intent
+# can be behind one payment row at most. Duplicates already in the table stop the upgrade. A
+# database from before payment intents gets the table here, so its lookups can be checked:
+# by idempotency key on submit and polling, by reference for the payment row upsert, and by
+# payment for the intent's link to it.
+@migration(15, query_plans=[
+    ("SELECT id FROM payment_intent WHERE user_id = 1 AND idempotency_key = 'key'", 'ix_payment_intent_key'),
+    ("SELECT id FROM payment WHERE reference = 'auth_1'", 'ix_payment_reference'),
+    ("SELECT id FROM payment_intent WHERE payment_id = 1", 'ix_payment_intent_payment'),
+])
+def add_payment_intent_claims(connection):
+    duplicates = connection.exec_driver_sql(
+        'SELECT reference FROM payment WHERE reference IS NOT NULL GROUP BY reference HAVING count(*) > 1'
+    ).scalars().all()
+    if duplicates:
+        raise RuntimeError(f'Payments share a reference, fix these before upgrading: {duplicates}')
+    connection.exec_driver_sql('DROP INDEX IF EXISTS ix_payment_reference')
+    connection.exec_driver_sql('CREATE UNIQUE INDEX ix_payment_reference ON payment (reference)')
+    if not inspect(connection).has_table('payment_intent'):
+        PaymentIntent.__table__.create(connection)
+        return
+    connection.exec_driver_sql('ALTER TABLE payment_intent ADD COLUMN claim_token VARCHAR(32)')
+    connection.exec_driver_sql('ALTER TABLE payment_intent ADD COLUMN claimed_at DATETIME')
+    connection.exec_driver_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_payment_intent_payment ON payment_intent (payment_id)')
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    upgrade_database()
+    print('Database is at schema version', schema_version())
+
+# Bring an existing database up to date, then create any missing tables within app context
 with app.app_context():
-    db.create_all()
+    if inspect(db.engine).has_table('user'):
+        upgrade_database()
+        db.create_all()
+    else:
+        db.create_all()
+        stamp_database()
+
+
+# Insert a reservation only while the slot still has room. The capacity check and the
+# insert are a single INSERT ... SELECT statement, so concurrent bookings are serialized
+# by the database and can never push a slot over its capacity.
+def _slot_has_room(location, selected_date, start_minute):
+    taken = select(func.count(Reservation.id)).where(
+        Reservation.location == location,
+        Reservation.selected_date == selected_date,
+        Reservation.start_minute == start_minute,
+    ).scalar_subquery()
+    held = select(func.count(SlotHold.id)).where(
+        SlotHold.location == location,
+        SlotHold.selected_date == selected_date,
+        SlotHold.start_minute == start_minute,
+        SlotHold.expires_at > bindparam('now', type_=db.DateTime),
+    ).scalar_subquery()
+    capacity = func.coalesce(
+        select(SlotCapacity.capacity).where(
+            SlotCapacity.location == location,
+            SlotCapacity.selected_date == selected_date,
+            SlotCapacity.start_minute == start_minute,
+        ).scalar_subquery(),
+        bindparam('default_capacity', type_=db.Integer),
+    )
+    return taken + held < capacity
+
+# BOOKING_RULES as SQL conditions. Both are indexed lookups on the resident's own reservations
+# for the day or week, so they cost the same however long the booking history is.
+def _no_overlap(username, selected_date, start_minute, end_minute):
+    overlapping = select(Reservation.id).where(
+        Reservation.username == username,
+        Reservation.selected_date == selected_date,
+        Reservation.start_minute < end_minute,
+        Reservation.end_minute > start_minute,
+    ).exists()
+    return or_(~bindparam('no_overlap', type_=db.Boolean), ~overlapping)
+
+def _under_weekly_quota(username):
+    unit_residents = select(User.name).where(
+        User.unit_number == select(User.unit_number).where(User.name == username).scalar_subquery())
+    booked_this_week = select(func.count(Reservation.id)).where(
+        Reservation.username.in_(unit_residents),
+        Reservation.selected_date.between(bindparam('week_start', type_=db.Date), bindparam('week_end', type_=db.Date)),
+    ).scalar_subquery()
+    max_per_week = bindparam('max_per_week', type_=db.Integer)
+    return or_(max_per_week.is_(None), booked_this_week < max_per_week)
+
+def _within_booking_rules(username, selected_date, start_minute, end_minute):
+    return and_(_no_overlap(username, selected_date, start_minute, end_minute), _under_weekly_quota(username))
+
+def _build_booking_statement():
+    username = bindparam('username', type_=db.String)
+    location = bindparam('location', type_=db.String)
+    selected_date = bindparam('selected_date', type_=db.Date)
+    start_minute = bindparam('start_minute', type_=db.Integer)
+    end_minute = bindparam('end_minute', type_=db.Integer)
+
+    user_id = select(User.id).where(User.name == username).scalar_subquery()
+
+    return insert(Reservation).from_select(
+        ['user_id', 'username', 'location', 'selected_date', 'start_minute', 'end_minute'],
+        select(user_id, username, location, selected_date, start_minute, end_minute).where(
+            _slot_has_room(location, selected_date, start_minute),
+            _within_booking_rules(username, selected_date, start_minute, end_minute)),
+    )
+
+booking_statement = _build_booking_statement()
+
+# Parameters for booking_statement and the other statements that check _slot_has_room
+# and _within_booking_rules
+def booking_params(username, location, selected_date, start_minute):
+    week_start = selected_date - timedelta(days=selected_date.weekday())
+    return {
+        'username': username,
+        'location': location,
+        'selected_date': selected_date,
+        'start_minute': start_minute,
+        'end_minute': SLOT_END_MINUTE[start_minute],
+        'default_capacity': app.config['FACILITY_CAPACITY'][location],
+        'now': datetime.now(),
+        'no_overlap': app.config['BOOKING_RULES']['no_overlap'],
+        'max_per_week': app.config['BOOKING_RULES']['max_per_week_per_unit'],
+        'week_start': week_start,
+        'week_end': week_start + timedelta(days=6),
+    }
+
+# Why a booking was refused: 'overlap', 'quota' or 'full'
+def _build_refusal_checks():
+    username = bindparam('username', type_=db.String)
+    selected_date = bindparam('selected_date', type_=db.Date)
+    start_minute = bindparam('start_minute', type_=db.Integer)
+    end_minute = bindparam('end_minute', type_=db.Integer)
+    return [
+        ('overlap', select(_no_overlap(username, selected_date, start_minute, end_minute))),
+        ('quota', select(_under_weekly_quota(username))),
+    ]
+
+refusal_checks = _build_refusal_checks()
+
+def booking_refusal(username, location, selected_date, start_minute):
+    params = booking_params(username, location, selected_date, start_minute)
+    for reason, check in refusal_checks:
+        if not db.session.execute(check, params).scalar():
+            return reason
+    return 'full'
+
+def refusal_message(reason):
+    if reason == 'overlap':
+        return "You already have a booking at this time."
+    if reason == 'quota':
+        return (f"Your unit has reached its limit of {app.config['BOOKING_RULES']['max_per_week_per_unit']} "
+                "bookings for that week.")
+    return "Sorry, this time slot is fully booked. Please choose another slot."
+
+# Try to claim a seat in the slot, returns False if the slot is already full. A hold the
+# resident placed is released in the same transaction, so the place it kept is theirs. When
+# the booking is refused, or the hold was for another slot, that place is offered to others.
+def book_slot(username, location, selected_date, start_minute, hold_token=None):
+    connection = db.session.connection()
+    released = []
+    if hold_token:
+        released = connection.execute(SlotHold.__table__.delete().where(
+            SlotHold.token == hold_token, SlotHold.username == username,
+        ).returning(SlotHold.location, SlotHold.selected_date, SlotHold.start_minute)).all()
+    result = connection.execute(booking_statement, booking_params(username, location, selected_date, start_minute))
+    if result.rowcount == 1:
+        record_occupancy(connection, [(location, selected_date, start_minute, 1)])
+    db.session.commit()
+    if result.rowcount == 1:
+        invalidate_availability(location, selected_date)
+        slot_released([slot for slot in released if tuple(slot) != (location, selected_date, start_minute)])
+        return True
+    slot_released(released)
+    return False
+
+# Dates of a weekly pattern: the given weekdays (0 = Monday) of each week, starting at first_date
+def recurring_dates(first_date, weekdays, weeks):
+    week_start = first_date - timedelta(days=first_date.weekday())
+    return sorted(
+        week_start + timedelta(weeks=week, days=weekday)
+        for week in range(weeks)
+        for weekday in set(weekdays)
+        if week_start + timedelta(weeks=week, days=weekday) >= first_date
+    )
+
+# Book the same slot on many dates in one transaction with a single executemany of the
+# conditional insert. Full dates are found up front with one aggregate query. Without
+# allow_partial nothing is booked when any date fails. Returns (booked, failed) dates.
+def book_recurring(username, location, start_minute, dates, allow_partial=False):
+    if not dates:
+        return [], []
+    booked = get_booked_counts(location, dates[0], dates[-1])
+    capacities = slot_capacities(location, dates[0], dates[-1])
+    default_capacity = app.config['FACILITY_CAPACITY'][location]
+    failed = [
+        day for day in dates
+        if booked[day].get(start_minute, 0) >= capacities.get((day, start_minute), default_capacity)
+    ]
+    if failed and not allow_partial:
+        return [], failed
+
+    wanted = [day for day in dates if day not in failed]
+    if not wanted:
+        return [], failed
+    result = db.session.connection().execute(
+        booking_statement, [booking_params(username, location, day, start_minute) for day in wanted])
+
+    if result.rowcount != len(wanted):
+        # A slot filled up since the counts were read or a date breaks a booking rule. Redo the
+        # inserts one at a time in a new transaction to find out which dates fail.
+        db.session.rollback()
+        connection = db.session.connection()
+        booked_dates = []
+        for day in wanted:
+            if connection.execute(booking_statement, booking_params(username, location, day, start_minute)).rowcount:
+                booked_dates.append(day)
+            else:
+                failed.append(day)
+        failed.sort()
+        if failed and not allow_partial:
+            db.session.rollback()
+            invalidate_availability_dates(location, wanted)
+            return [], failed
+        wanted = booked_dates
+
+    record_occupancy(db.session.connection(), [(location, day, start_minute, 1) for day in wanted])
+    db.session.commit()
+    invalidate_availability_dates(location, wanted)
+    return wanted, failed
+
+def invalidate_availability_dates(location, dates):
+    for day in dates:
+        invalidate_availability(location, day)
+
+# Time booking_statement for residents with more and more past reservations. The overlap and
+# quota checks are index range lookups, so the time per booking should stay flat as history
+# grows. Everything runs in one transaction per history size that is rolled back afterwards.
+@app.cli.command('bench-booking')
+@click.option('--history', default='0,100,1000,10000', help='Past reservations per resident, comma separated.')
+@click.option('--residents', type=int, default=20, help='Residents booking, each in a unit of their own.')
+@click.option('--bookings', type=int, default=500, help='Bookings timed at each history size.')
+def bench_booking_command(history, residents, bookings):
+    locations = list(app.config['FACILITY_CAPACITY'])
+    for size in [int(value) for value in history.split(',')]:
+        connection = db.session.connection()
+        names = [f'bench-{number:03d}' for number in range(residents)]
+        connection.execute(insert(User.__table__), [
+            {'name': name, 'email': f'{name}@example.com', 'password': '', 'unit_number': f'BENCH-{name}'}
+            for name in names])
+        past = date.today() - timedelta(days=1)
+        if size:
+            connection.execute(insert(Reservation.__table__), [
+                {'username': name, 'location': locations[index % len(locations)],
+                 'selected_date': past - timedelta(days=index // len(TIME_SLOTS)),
+                 'start_minute': TIME_SLOTS[index % len(TIME_SLOTS)][0],
+                 'end_minute': TIME_SLOTS[index % len(TIME_SLOTS)][1]}
+                for name in names for index in range(size)])
+
+        timings = []
+        for number in range(bookings):
+            selected_date = date.today() + timedelta(days=1 + number // residents % 60)
+            params = booking_params(names[number % residents], locations[number % len(locations)], selected_date,
+                                    TIME_SLOTS[number % len(TIME_SLOTS)][0])
+            started = time.perf_counter()
+            connection.execute(booking_statement, params)
+            timings.append(time.perf_counter() - started)
+        db.session.rollback()
+
+        timings.sort()
+        print(f'{size} past reservations per resident: {sum(timings) / len(timings) * 1e6:.0f} us mean, '
+              f'{timings[int(len(timings) * 0.95)] * 1e6:.0f} us p95 per booking')
+
+
+# Booked seats per (location, date), each value maps a time slot to its booked count
+availability_cache = TTLCache(maxsize=4096, ttl=app.config['AVAILABILITY_CACHE_TTL'])
+# Bumped on every invalidation so a query that raced with a booking is never cached
+availability_generation = [0]
+availability_lock = threading.Lock()
+
+def invalidate_availability(location, selected_date):
+    with availability_lock:
+        availability_generation[0] += 1
+        availability_cache.pop((location, selected_date))
+
+# Return {date: {start minute: taken count}} for every day from start to end inclusive.
+# Days missing from the cache are filled with one GROUP BY query over the reservations
+# and the holds that have not expired yet.
+def get_booked_counts(location, start, end):
+    days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+    booked = {}
+    missing = []
+    for day in days:
+        counts = availability_cache.get((location, day))
+        if counts is None:
+            missing.append(day)
+        else:
+            booked[day] = counts
+
+    if missing:
+        generation = availability_generation[0]
+        taken = union_all(
+            select(Reservation.selected_date, Reservation.start_minute)
+            .where(Reservation.location == location, Reservation.selected_date.between(missing[0], missing[-1])),
+            select(SlotHold.selected_date, SlotHold.start_minute)
+            .where(SlotHold.location == location, SlotHold.selected_date.between(missing[0], missing[-1]),
+                   SlotHold.expires_at > datetime.now()),
+        ).subquery()
+        rows = db.session.execute(
+            select(taken.c.selected_date, taken.c.start_minute, func.count())
+            .group_by(taken.c.selected_date, taken.c.start_minute)
+        ).all()
+        fresh = {day: {} for day in missing}
+        for selected_date, start_minute, count in rows:
+            if selected_date in fresh:
+                fresh[selected_date][start_minute] = count
+        with availability_lock:
+            if generation == availability_generation[0]:
+                for day, counts in fresh.items():
+                    availability_cache.set((location, day), counts)
+        booked.update(fresh)
+
+    return booked
+
+# Capacity overrides of a facility between start and end, keyed by (date, start minute)
+def slot_capacities(location, start, end):
+    return {
+        (row.selected_date, row.start_minute): row.capacity
+        for row in SlotCapacity.query.filter(
+            SlotCapacity.location == location, SlotCapacity.selected_date.between(start, end)
+        )
+    }
+
+# Remaining capacity for every slot of a facility between start and end inclusive
+def get_availability(location, start, end):
+    booked = get_booked_counts(location, start, end)
+    overrides = slot_capacities(location, start, end)
+    default_capacity = app.config['FACILITY_CAPACITY'][location]
+
+    slots = []
+    for day in sorted(booked):
+        for start_minute, end_minute in TIME_SLOTS:
+            capacity = overrides.get((day, start_minute), default_capacity)
+            taken = booked[day].get(start_minute, 0)
+            slots.append({
+                'date': day.strftime('%Y-%m-%d'),
+                'start_minute': start_minute,
+                'end_minute': end_minute,
+                'time': format_time_slot(start_minute, end_minute),
+                'capacity': capacity,
+                'booked': taken,
+                'remaining': max(capacity - taken, 0),
+            })
+    return slots
+
+SLOT_FIELDS = ('location', 'selected_date', 'start_minute')
+
+# (old slot, new slot) of a reservation or capacity override, the old slot is None unless
+# the pending changes move it to another slot
+def slot_change(obj):
+    state = inspect(obj)
+    old_values = [state.attrs[name].history.deleted for name in SLOT_FIELDS]
+    new_slot = (obj.location, obj.selected_date, obj.start_minute)
+    if not any(old_values):
+        return None, new_slot
+    return tuple(old[0] if old else new for old, new in zip(old_values, new_slot)), new_slot
+
+# Remember which slots a flush touches and act on them once the commit succeeds: drop the
+# cached availability and let the waitlist fill any freed places. This covers cancellations
+# and admin edits that go through the ORM.
+@event.listens_for(Session, 'before_flush')
+def collect_slot_changes(db_session, flush_context, instances):
+    slots = db_session.info.setdefault('changed_slots', set())
+    for obj in list(db_session.new) + list(db_session.dirty) + list(db_session.deleted):
+        if not isinstance(obj, (Reservation, SlotCapacity)):
+            continue
+        old_slot, new_slot = slot_change(obj)
+        slots.add(new_slot)
+        if old_slot:
+            slots.add(old_slot)
+
+@event.listens_for(Session, 'after_commit')
+def apply_slot_changes(db_session):
+    for location, selected_date, start_minute in db_session.info.pop('changed_slots', ()):
+        invalidate_availability(location, selected_date)
+        queue_waitlist_promotion(location, selected_date, start_minute)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_slot_changes(db_session):
+    db_session.info.pop('changed_slots', None)
+
+
+# Add (location, day, start_minute, delta) changes to occupancy_daily in the caller's transaction
+occupancy_upsert = sqlite_insert(OccupancyDaily).values(
+    location=bindparam('location'), day=bindparam('day'), start_minute=bindparam('start_minute'),
+    booked=bindparam('delta'),
+)
+occupancy_upsert = occupancy_upsert.on_conflict_do_update(
+    index_elements=['location', 'day', 'start_minute'],
+    set_={'booked': OccupancyDaily.booked + occupancy_upsert.excluded.booked},
+)
+
+def record_occupancy(connection, changes):
+    if changes:
+        connection.execute(occupancy_upsert, [
+            {'location': location, 'day': day, 'start_minute': start_minute, 'delta': delta}
+            for location, day, start_minute, delta in changes
+        ])
+
+# Tables that still refer to residents by name follow a rename, so no history is left behind
+# under the old name. Names are unique, so the old name matches this user's rows only.
+USERNAME_COLUMNS = [
+    (Reservation, Reservation.username), (ReservationArchive, ReservationArchive.username),
+    (Payment, Payment.name), (WaitlistEntry, WaitlistEntry.username), (SlotHold, SlotHold.username),
+    (Notification, Notification.username),
+]
+
+@event.listens_for(User, 'after_update')
+def rename_user_rows(mapper, connection, target):
+    old_names = inspect(target).attrs.name.history.deleted
+    if old_names and old_names[0] != target.name:
+        for model, column in USERNAME_COLUMNS:
+            connection.execute(model.__table__.update().where(column == old_names[0]).values({column.key: target.name}))
+
+# Reservations created, moved or deleted through the ORM (cancellations, admin edits) update
+# the rollup in the same flush. Archiving is a plain DELETE and deliberately leaves it alone.
+@event.listens_for(Session, 'after_flush')
+def update_occupancy_rollup(db_session, flush_context):
+    changes = []
+    for obj in db_session.new:
+        if isinstance(obj, Reservation):
+            changes.append((obj.location, obj.selected_date, obj.start_minute, 1))
+    for obj in db_session.deleted:
+        if isinstance(obj, Reservation):
+            changes.append((obj.location, obj.selected_date, obj.start_minute, -1))
+    for obj in db_session.dirty:
+        if not isinstance(obj, Reservation):
+            continue
+        old_slot, new_slot = slot_change(obj)
+        if old_slot:
+            changes.append(old_slot + (-1,))
+            changes.append(new_slot + (1,))
+    record_occupancy(db_session.connection(), changes)
+
+# Recount the rollup from reservation and reservation_archive, batch_days days per transaction
+def rebuild_occupancy(start=None, end=None, batch_days=31):
+    if start is None or end is None:
+        bounds = [
+            db.session.execute(select(func.min(model.selected_date), func.max(model.selected_date))).one()
+            for model in (Reservation, ReservationArchive)
+        ]
+        bounds = [bound for bound in bounds if bound[0] is not None]
+        if not bounds:
+            return 0
+        start = start or min(first for first, _ in bounds)
+        end = end or max(last for _, last in bounds)
+
+    batches = 0
+    batch_start = start
+    while batch_start <= end:
+        batch_end = min(batch_start + timedelta(days=batch_days - 1), end)
+        booked = union_all(
+            select(Reservation.location, Reservation.selected_date, Reservation.start_minute)
+            .where(Reservation.selected_date.between(batch_start, batch_end)),
+            select(ReservationArchive.location, ReservationArchive.selected_date, ReservationArchive.start_minute)
+            .where(ReservationArchive.selected_date.between(batch_start, batch_end)),
+        ).subquery()
+        connection = db.session.connection()
+        connection.execute(OccupancyDaily.__table__.delete().where(OccupancyDaily.day.between(batch_start, batch_end)))
+        connection.execute(insert(OccupancyDaily).from_select(
+            ['location', 'day', 'start_minute', 'booked'],
+            select(booked.c.location, booked.c.selected_date, booked.c.start_minute, func.count())
+            .group_by(booked.c.location, booked.c.selected_date, booked.c.start_minute),
+        ))
+        db.session.commit()
+        batches += 1
+        batch_start = batch_end + timedelta(days=1)
+    return batches
+
+@app.cli.command('rebuild-occupancy')
+@click.option('--days', type=int, default=None, help='Only rebuild the last DAYS days (default: everything).')
+def rebuild_occupancy_command(days):
+    batches = rebuild_occupancy(start=date.today() - timedelta(days=days) if days else None)
+    print('Rebuilt occupancy in', batches, 'batches')
+
+
+# One page of a resident's upcoming (soonest first) or past (latest first) reservations.
+# Pages are found by seeking the (selected_date, id) index from the cursor of the previous
+# page, so every page costs the same however long the history is. Past pages seek the
+# archive table the same way and merge the two sorted results.
+def reservation_page(username, scope, cursor=None):
+    page_size = app.config['HISTORY_PAGE_SIZE']
+    if scope == 'past':
+        pages = []
+        for model in (Reservation, ReservationArchive):
+            query = model.query.filter(model.username == username, model.selected_date < date.today())
+            if cursor:
+                query = query.filter(tuple_(model.selected_date, model.id) < tuple_(*cursor))
+            query = query.order_by(model.selected_date.desc(), model.id.desc())
+            pages.append(query.limit(page_size + 1).all())
+        reservations = list(heapq.merge(*pages, key=lambda row: (row.selected_date, row.id), reverse=True))
+    else:
+        query = Reservation.query.filter(Reservation.username == username, Reservation.selected_date >= date.today())
+        if cursor:
+            query = query.filter(tuple_(Reservation.selected_date, Reservation.id) > tuple_(*cursor))
+        query = query.order_by(Reservation.selected_date, Reservation.id)
+        reservations = query.limit(page_size + 1).all()
+
+    next_cursor = None
+    if len(reservations) > page_size:
+        reservations = reservations[:page_size]
+        last = reservations[-1]
+        next_cursor = f"{last.selected_date.strftime('%Y-%m-%d')}.{last.id}"
+    return reservations, next_cursor
+
+# Cursors look like 2024-01-31.42, returns None for a missing or malformed cursor
+def parse_history_cursor(cursor):
+    try:
+        selected_date, reservation_id = cursor.split('.')
+        return datetime.strptime(selected_date, '%Y-%m-%d').date(), int(reservation_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+# One page of a resident's fee ledger, oldest first. The running balance and the subtotal
+# of each row's month are window sums over all of the resident's rows, the page is then
+# sought from the (payment_date, id) cursor of the previous page. One row past the page is
+# read so the template knows whether the last month on the page continues on the next one.
+def payment_ledger_page(user_id, cursor=None):
+    page_size = app.config['LEDGER_PAGE_SIZE']
+    month = func.strftime('%Y-%m', Payment.payment_date)
+    ledger = (
+        select(Payment.id, Payment.payment_date, Payment.payment_method, Payment.payment_amount,
+               month.label('month'),
+               func.sum(Payment.payment_amount).over(order_by=(Payment.payment_date, Payment.id)).label('balance'),
+               func.sum(Payment.payment_amount).over(partition_by=month).label('month_total'))
+        .where(Payment.user_id == user_id)
+        .subquery()
+    )
+    query = select(ledger).order_by(ledger.c.payment_date, ledger.c.id).limit(page_size + 1)
+    if cursor:
+        query = query.where(tuple_(ledger.c.payment_date, ledger.c.id) > tuple_(*cursor))
+    rows = db.session.execute(query).all()
+
+    next_cursor = None
+    entries = []
+    for index, row in enumerate(rows[:page_size]):
+        following = rows[index + 1] if index + 1 < len(rows) else None
+        entries.append((row, following is None or following.month != row.month))
+    if len(rows) > page_size:
+        last = rows[page_size - 1]
+        next_cursor = f"{last.payment_date.strftime('%Y-%m-%d')}.{last.id}"
+    return entries, next_cursor
+
+# A resident's balance, one primary key read from resident_balance
+def resident_balance(user_id):
+    balance = db.session.execute(select(ResidentBalance.balance).where(ResidentBalance.user_id == user_id)).scalar()
+    return Decimal('0.00') if balance is None else balance
+
+# Per-month subtotals of a resident's fees, aggregated in SQL
+def payment_ledger_totals(user_id):
+    month = func.strftime('%Y-%m', Payment.payment_date)
+    months = db.session.execute(
+        select(month.label('month'), func.count(Payment.id).label('count'), func.sum(Payment.payment_amount).label('total'))
+        .where(Payment.user_id == user_id)
+        .group_by(month)
+        .order_by(month)
+    ).all()
+    return sum(row.count for row in months), months
+
+
+# Billing periods are months written as YYYY-MM, returns None for anything else
+def parse_billing_period(text):
+    try:
+        return datetime.strptime(text, '%Y-%m').strftime('%Y-%m')
+    except (TypeError, ValueError):
+        return None
+
+# Charge every user each active fee for the period with one INSERT ... SELECT. Rows already
+# billed for the same user, fee and period hit the ix_payment_invoice key and are skipped,
+# so a rerun only fills in users or fees added since. Returns the number of new rows.
+def generate_invoices(period):
+    billed_on = datetime.strptime(period, '%Y-%m').date()
+    charges = (
+        select(User.id, User.name, bindparam('payment_method', 'Invoice', type_=db.String), FeeSchedule.amount,
+               bindparam('payment_date', billed_on, type_=db.Date), FeeSchedule.fee_code,
+               bindparam('period', period, type_=db.String))
+        .select_from(User)
+        .join(FeeSchedule, true())
+        .where(FeeSchedule.active.is_(True))
+    )
+    result = db.session.execute(
+        sqlite_insert(Payment)
+        .from_select(['user_id', 'name', 'payment_method', 'amount_cents', 'payment_date', 'fee_code', 'period'],
+                     charges)
+        .on_conflict_do_nothing(index_elements=['user_id', 'fee_code', 'period'])
+    )
+    db.session.commit()
+    return result.rowcount
+
+@app.cli.command('generate-invoices')
+@click.option('--period', default=None, help='Month to bill as YYYY-MM, defaults to the current month.')
+def generate_invoices_command(period):
+    billing_period = parse_billing_period(period or date.today().strftime('%Y-%m'))
+    if billing_period is None:
+        raise click.BadParameter('Use YYYY-MM.', param_hint='--period')
+    started = time.perf_counter()
+    created = generate_invoices(billing_period)
+    print(f'Created {created} invoices for {billing_period} in {time.perf_counter() - started:.2f}s')
+
+
+# Card payments go through payment intents. /submit stores the intent under the form's
+# idempotency key and returns straight away, worker threads charge it through the gateway
+# and the payment page polls its status. Submitting the same key again finds the same intent
+# through the unique (user_id, idempotency_key) index, so double clicks and retries are only
+# charged once. A successful charge adds a negative Payment row, which lowers the resident's
+# balance through the payment triggers.
+class FakeGateway:
+    def __init__(self):
+        self.charges = {}
+        self._lock = threading.Lock()
+
+    def charge(self, idempotency_key, amount_cents, source):
+        with self._lock:
+            if idempotency_key not in self.charges:
+                if source.endswith('0002'):
+                    self.charges[idempotency_key] = ('failed', None, 'The card was declined.')
+                else:
+                    self.charges[idempotency_key] = ('succeeded', 'fake_' + secrets.token_hex(8), None)
+            return self.charges[idempotency_key]
+
+# Authorizes then captures over HTTP. Both calls carry the idempotency key, so repeating a
+# charge after a timeout returns the first outcome instead of charging twice.
+class HTTPGateway:
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _post(self, path, payload):
+        gateway_request = urllib.request.Request(
+            self.base_url + path, data=json.dumps(payload).encode(), method='POST',
+            headers={'Content-Type': 'application/json', 'Idempotency-Key': payload['idempotency_key']})
+        with urllib.request.urlopen(gateway_request, timeout=self.timeout) as response:
+            return json.load(response)
+
+    def charge(self, idempotency_key, amount_cents, source):
+        authorization = self._post('/authorize', {
+            'idempotency_key': idempotency_key, 'amount_cents': amount_cents, 'currency': 'MYR', 'source': source})
+        if authorization['status'] != 'authorized':
+            return 'failed', authorization.get('id'), authorization.get('reason') or 'The payment was declined.'
+        capture = self._post('/capture', {'idempotency_key': idempotency_key, 'authorization_id': authorization['id']})
+        if capture['status'] != 'captured':
+            return 'failed', authorization['id'], capture.get('reason') or 'The payment could not be completed.'
+        return 'succeeded', authorization['id'], None
+
+payment_gateways = []
+
+def payment_gateway():
+    if not payment_gateways:
+        setting = app.config['PAYMENT_GATEWAY']
+        payment_gateways.append(FakeGateway() if setting == 'fake'
+                                else HTTPGateway(setting, app.config['PAYMENT_GATEWAY_TIMEOUT']))
+    return payment_gateways[0]
+
+def find_payment_intent(user_id, idempotency_key):
+    return PaymentIntent.query.filter_by(user_id=user_id, idempotency_key=idempotency_key).first()
+
+# Insert the intent unless the key was used before, then queue it for charging
+def create_payment_intent(user_id, idempotency_key, amount, method, source):
+    intent_id = db.session.execute(
+        sqlite_insert(PaymentIntent.__table__).values(
+            user_id=user_id, idempotency_key=idempotency_key, amount_cents=amount, method=method, source=source,
+            status='pending', created_at=datetime.now(), updated_at=datetime.now(),
+        ).on_conflict_do_nothing(index_elements=['user_id', 'idempotency_key']).returning(PaymentIntent.id)
+    ).scalar()
+    db.session.commit()
+    if intent_id is not None:
+        queue_payment_intent(intent_id)
+    return find_payment_intent(user_id, idempotency_key)
+
+payment_queue = queue.Queue()
+payment_workers_lock = threading.Lock()
+payment_workers = []
+
+# Payment method recorded on the payment row of each kind of intent
+PAYMENT_METHOD_LABELS = {'card': 'Card', 'ewallet': 'E-Wallet'}
+
+def queue_payment_intent(intent_id):
+    payment_queue.put(intent_id)
+    with payment_workers_lock:
+        while len(payment_workers) < app.config['PAYMENT_WORKERS']:
+            worker = threading.Thread(target=run_payment_worker, name='payment-worker', daemon=True)
+            worker.start()
+            payment_workers.append(worker)
+
+def run_payment_worker():
+    while True:
+        intent_id = payment_queue.get()
+        with app.app_context():
+            try:
+                process_payment_intent(intent_id)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Charging payment intent %s failed', intent_id)
+        payment_queue.task_done()
+
+# An intent can be claimed while it is pending, or while processing once the claim of the
+# worker charging it has run out
+def claimable_intent():
+    intents = PaymentIntent.__table__
+    expired = datetime.now() - timedelta(seconds=app.config['PAYMENT_CLAIM_SECONDS'])
+    return or_(intents.c.status == 'pending', and_(intents.c.status == 'processing', intents.c.claimed_at < expired))
+
+# Claim an intent under a token of this worker, charge it with no transaction open, then record
+# the outcome. The outcome is only written while the claim is still this worker's, so a worker
+# whose claim ran out and was taken over adds nothing. The gateway reference is unique on
+# payment rows, so one charge can never be credited twice.
+def process_payment_intent(intent_id):
+    intents = PaymentIntent.__table__
+    claim_token = secrets.token_hex(16)
+    claimed = db.session.execute(
+        intents.update().where(intents.c.id == intent_id, claimable_intent())
+        .values(status='processing', claim_token=claim_token, claimed_at=datetime.now(), updated_at=datetime.now())
+        .returning(intents.c.user_id, intents.c.amount_cents, intents.c.method, intents.c.source)
+    ).first()
+    db.session.commit()
+    if claimed is None:
+        return
+    user_id, amount, method, source = claimed
+
+    attempts = app.config['PAYMENT_MAX_ATTEMPTS']
+    for attempt in range(attempts):
+        try:
+            status, reference, error = payment_gateway().charge(f'intent-{intent_id}', int(amount * 100), source)
+            break
+        except (OSError, ValueError, KeyError):
+            app.logger.warning('Payment gateway error for intent %s (attempt %s)', intent_id, attempt + 1, exc_info=True)
+            if attempt + 1 < attempts:
+                time.sleep(2 ** attempt)
+    else:
+        status, reference, error = 'failed', None, 'The payment service is unavailable, please try again later.'
+
+    owned = intents.c.id == intent_id, intents.c.status == 'processing', intents.c.claim_token == claim_token
+    finished = db.session.execute(intents.update().where(*owned).values(
+        status=status, gateway_reference=reference, error=error, claim_token=None, updated_at=datetime.now(),
+    ).returning(intents.c.id)).scalar()
+    if finished is None:
+        db.session.rollback()
+        app.logger.warning('Claim on payment intent %s was taken over, its outcome is left to the new owner', intent_id)
+        return
+    if status == 'succeeded':
+        db.session.execute(
+            sqlite_insert(Payment.__table__).values(
+                user_id=user_id, name=select(User.name).where(User.id == user_id).scalar_subquery(),
+                payment_method=PAYMENT_METHOD_LABELS[method], amount_cents=-amount, payment_date=date.today(),
+                reference=reference,
+            ).on_conflict_do_nothing(index_elements=['reference']))
+        db.session.execute(intents.update().where(intents.c.id == intent_id).values(
+            payment_id=select(Payment.id).where(Payment.reference == reference).scalar_subquery()))
+    db.session.commit()
+
+def queue_abandoned_payment_intents():
+    with app.app_context():
+        for intent_id in db.session.execute(select(PaymentIntent.id).where(claimable_intent())).scalars():
+            queue_payment_intent(intent_id)
+
+# Queue the intents a stopped process left pending at startup, then look again every
+# PAYMENT_CLAIM_SECONDS for intents whose claim ran out, e.g. because the process charging
+# them stopped mid-charge. The gateway idempotency key makes charging those again safe.
+# Intents other workers are charging right now are left alone.
+def run_payment_sweeper():
+    while True:
+        try:
+            queue_abandoned_payment_intents()
+        except Exception:
+            app.logger.exception('Looking for abandoned payment intents failed')
+        time.sleep(app.config['PAYMENT_CLAIM_SECONDS'])
+
+
+# Uploaded CSV files (resident imports, bank statements) are read a chunk of parsed rows at a
+# time. parse_row gets the line number and the row read by the csv.DictReader.
+def read_csv_chunks(reader, size, parse_row):
+    chunk = []
+    for row in reader:
+        chunk.append(parse_row(reader.line_num, row))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Save an uploaded CSV and process it in a background thread. The job dict (its state, the
+# last line read, counters and a failure message) is kept in jobs under job_id for the admin
+# page to poll, and process(lines, job) updates the counters as it goes.
+def start_upload_job(jobs, job_id, upload, counters, process, description):
+    upload_fd, upload_path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(upload_fd, 'wb') as saved:
+        upload.save(saved)
+    job = dict(counters, state='running', line=0, message=None)
+    jobs.set(job_id, job)
+
+    def run():
+        with app.app_context():
+            try:
+                with open(upload_path, newline='', encoding='utf-8-sig') as lines:
+                    process(lines, job)
+                job['state'] = 'finished'
+            except Exception as error:
+                db.session.rollback()
+                app.logger.exception('%s failed', description)
+                job.update(state='failed', message=str(error))
+            finally:
+                os.remove(upload_path)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+# Bank statement reconciliation. The statement CSV is read a chunk of lines at a time. For each
+# chunk the receipts (negative payment rows) dated within its date range, widened by the date
+# window, are loaded once and indexed in memory by reference and by amount and date, so each
+# line is matched with a few dictionary lookups: by reference first, otherwise by the same
+# amount on the nearest date within the window. Results are inserted a chunk at a time, and
+# finally the receipts of the statement period that no line matched are recorded as missing.
+STATEMENT_CSV_FIELDS = ('date', 'amount', 'reference')
+
+def parse_statement_row(line_number, row):
+    line = {'line_number': line_number, 'statement_date': None, 'amount_cents': None,
+            'reference': (row.get('reference') or '').strip()[:64] or None,
+            'description': (row.get('description') or '').strip()[:200] or None,
+            'status': 'invalid', 'payment_id': None, 'note': None}
+    try:
+        line['statement_date'] = date.fromisoformat((row.get('date') or '').strip())
+    except ValueError:
+        line['note'] = 'date must be YYYY-MM-DD'
+        return line
+    try:
+        amount = Decimal((row.get('amount') or '').strip().replace(',', '')).quantize(Decimal('0.01'))
+        is_receipt = amount > 0
+    except InvalidOperation:
+        line['note'] = 'amount is not a number'
+        return line
+    line['amount_cents'] = amount
+    if is_receipt:
+        line['status'] = None
+    else:
+        line['note'] = 'only receipts (positive amounts) are reconciled'
+    return line
+
+def receipts_between(start, end):
+    return db.session.execute(
+        select(Payment.id, Payment.payment_amount, Payment.payment_date, Payment.reference)
+        .where(Payment.payment_date.between(start, end), Payment.payment_amount < 0)
+    ).all()
+
+# Match the readable lines of a chunk, filling in their status, payment and note. References
+# are matched before amounts, so an amount match never takes a payment another line names.
+# Payments matched here or in earlier chunks are added to matched_ids and never matched twice.
+def match_statement_lines(lines, window, matched_ids):
+    by_reference = {}
+    by_amount_date = {}
+    for receipt in receipts_between(min(line['statement_date'] for line in lines) - window,
+                                    max(line['statement_date'] for line in lines) + window):
+        if receipt.id in matched_ids:
+            continue
+        if receipt.reference:
+            by_reference[receipt.reference] = receipt
+        by_amount_date.setdefault((-receipt.payment_amount, receipt.payment_date), []).append(receipt)
+    # Receipts without a reference are offered to amount matches first
+    for candidates in by_amount_date.values():
+        candidates.sort(key=lambda receipt: receipt.reference is not None)
+
+    # A reference can also name a payment dated outside the window
+    references = {line['reference'] for line in lines if line['reference'] and line['reference'] not in by_reference}
+    if references:
+        by_reference.update((receipt.reference, receipt) for receipt in db.session.execute(
+            select(Payment.id, Payment.payment_amount, Payment.payment_date, Payment.reference)
+            .where(Payment.reference.in_(references), Payment.payment_amount < 0)
+        ))
+
+    unresolved = []
+    for line in lines:
+        receipt = by_reference.get(line['reference'])
+        if receipt is None or receipt.id in matched_ids:
+            unresolved.append(line)
+            continue
+        matched_ids.add(receipt.id)
+        line['payment_id'] = receipt.id
+        if -receipt.payment_amount != line['amount_cents']:
+            line.update(status='mismatch', note=f'payment amount is RM{-receipt.payment_amount}')
+        elif abs(receipt.payment_date - line['statement_date']) > window:
+            line.update(status='mismatch', note=f'payment date is {receipt.payment_date}')
+        else:
+            line['status'] = 'matched'
+
+    # Nearest dates first, the earlier one first as banks post receipts after they are paid
+    offsets = [timedelta(0)] + [timedelta(days=days) for distance in range(1, window.days + 1)
+                                for days in (-distance, distance)]
+    for line in unresolved:
+        for offset in offsets:
+            candidates = by_amount_date.get((line['amount_cents'], line['statement_date'] + offset))
+            while candidates and candidates[0].id in matched_ids:
+                candidates.pop(0)
+            if candidates:
+                receipt = candidates.pop(0)
+                matched_ids.add(receipt.id)
+                line.update(status='matched', payment_id=receipt.id, note='matched by amount and date')
+                break
+        else:
+            line.update(status='unmatched', note='no payment matches this line')
+
+def reconcile_statement(lines, run, chunk_size=None, progress=None):
+    reader = csv.DictReader(lines)
+    missing = set(STATEMENT_CSV_FIELDS) - set(reader.fieldnames or ())
+    if missing:
+        raise ValueError(f"The CSV has no {', '.join(sorted(missing))} column")
+
+    window = timedelta(days=app.config['RECONCILE_DATE_WINDOW_DAYS'])
+    chunk_size = chunk_size or app.config['RECONCILE_CHUNK_SIZE']
+    matched_ids = set()
+    first = last = None
+    for chunk in read_csv_chunks(reader, chunk_size, parse_statement_row):
+        readable = [line for line in chunk if line['status'] is None]
+        if readable:
+            match_statement_lines(readable, window, matched_ids)
+            dates = [line['statement_date'] for line in readable]
+            first = min(dates + ([first] if first else []))
+            last = max(dates + ([last] if last else []))
+        db.session.execute(insert(ReconciliationLine.__table__), [dict(line, run_id=run.id) for line in chunk])
+        run.lines += len(chunk)
+        run.matched += sum(line['status'] == 'matched' for line in chunk)
+        run.discrepancies += sum(line['status'] != 'matched' for line in chunk)
+        db.session.commit()
+        if progress:
+            progress(reader.line_num, run.lines, run.matched, run.discrepancies)
+
+    if first is not None:
+        missing_receipts = [
+            {'run_id': run.id, 'line_number': None, 'statement_date': None, 'amount_cents': None,
+             'reference': receipt.reference, 'description': None, 'status': 'missing', 'payment_id': receipt.id,
+             'note': f'no statement line for the payment of RM{-receipt.payment_amount} on {receipt.payment_date}'}
+            for receipt in receipts_between(first, last) if receipt.id not in matched_ids
+        ]
+        for start in range(0, len(missing_receipts), chunk_size):
+            db.session.execute(insert(ReconciliationLine.__table__), missing_receipts[start:start + chunk_size])
+        run.discrepancies += len(missing_receipts)
+        db.session.commit()
+    return run.matched, run.discrepancies
+
+# csv.writer target that hands each formatted row back instead of storing it
+class CSVLineBuffer:
+    def write(self, line):
+        return line
+
+RECONCILIATION_REPORT_FIELDS = ['status', 'line', 'statement_date', 'statement_amount', 'reference', 'description',
+                                'payment_id', 'resident', 'payment_date', 'payment_amount', 'note']
+
+# Every line of a run that is not matched, with the payment it points at, as CSV text
+def reconciliation_report_lines(run_id):
+    writer = csv.writer(CSVLineBuffer())
+    yield writer.writerow(RECONCILIATION_REPORT_FIELDS)
+    rows = db.session.execute(
+        select(ReconciliationLine.status, ReconciliationLine.line_number, ReconciliationLine.statement_date,
+               ReconciliationLine.amount, ReconciliationLine.reference, ReconciliationLine.description,
+               ReconciliationLine.payment_id, Payment.name, Payment.payment_date, Payment.payment_amount,
+               ReconciliationLine.note)
+        .outerjoin(Payment, Payment.id == ReconciliationLine.payment_id)
+        .where(ReconciliationLine.run_id == run_id, ReconciliationLine.status != 'matched')
+        .order_by(ReconciliationLine.id)
+    )
+    for row in rows:
+        yield writer.writerow([row.status, row.line_number, row.statement_date, row.amount, row.reference,
+                               row.description, row.payment_id, row.name, row.payment_date,
+                               None if row.payment_amount is None else -row.payment_amount, row.note])
+
+@app.cli.command('reconcile-statement')
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--report', 'report_path', default='discrepancies.csv', help='Where the discrepancy report is written.')
+@click.option('--chunk-size', type=int, default=None, help='Statement lines matched per batch.')
+def reconcile_statement_command(csv_path, report_path, chunk_size):
+    def progress(line, lines, matched, discrepancies):
+        print(f'Line {line}: {matched} matched, {discrepancies} discrepancies')
+    run = ReconciliationRun(filename=os.path.basename(csv_path))
+    db.session.add(run)
+    db.session.commit()
+    started = time.perf_counter()
+    with open(csv_path, newline='', encoding='utf-8-sig') as lines:
+        matched, discrepancies = reconcile_statement(lines, run, chunk_size, progress)
+    with open(report_path, 'w', newline='') as report:
+        report.writelines(reconciliation_report_lines(run.id))
+    print(f'Run {run.id}: {matched} matched, {discrepancies} discrepancies in '
+          f'{time.perf_counter() - started:.2f}s, see {report_path}')
+
+# Reconciliations started from the admin page, by run id
+reconciliations = TTLCache(maxsize=100, ttl=24 * 3600)
+
+def start_reconciliation(upload):
+    run = ReconciliationRun(filename=os.path.basename(upload.filename))
+    db.session.add(run)
+    db.session.commit()
+    run_id = run.id
+
+    def reconcile(lines, job):
+        def progress(line, lines_read, matched, discrepancies):
+            job.update(line=line, matched=matched, discrepancies=discrepancies)
+        reconcile_statement(lines, db.session.get(ReconciliationRun, run_id), progress=progress)
+
+    start_upload_job(reconciliations, run_id, upload, {'matched': 0, 'discrepancies': 0}, reconcile,
+                     f'Reconciling statement {run_id}')
+    return run_id
+
+
+# Calendar feeds are addressed by a random per-user token instead of the login session,
+# calendar apps subscribe to the URL and poll it without ever signing in
+calendar_owners = TTLCache(maxsize=4096, ttl=300)
+
+def calendar_token_for(current_user):
+    if current_user.calendar_token:
+        return current_user.calendar_token
+    user = db.session.get(User, current_user.id)
+    user.calendar_token = secrets.token_urlsafe(32)
+    db.session.commit()
+    return user.calendar_token
+
+# Tokens are cached with the user id, which a rename leaves alone
+def calendar_owner(token):
+    user_id = calendar_owners.get(token)
+    if user_id is None:
+        user_id = db.session.execute(select(User.id).where(User.calendar_token == token)).scalar()
+        if user_id is not None:
+            calendar_owners.set(token, user_id)
+    return user_id
+
+# The feed changes when a reservation is added (new highest id), removed (lower count) or
+# edited (the user's calendar_version), so the three numbers make the ETag. They are read in
+# one statement from the user id index of reservation and the user's primary key.
+def calendar_etag(user_id):
+    version = select(User.calendar_version).where(User.id == user_id).scalar_subquery()
+    latest_id, total, edits = db.session.execute(
+        select(func.max(Reservation.id), func.count(Reservation.id), version)
+        .where(Reservation.user_id == user_id)).one()
+    return f'{latest_id or 0}-{total}-{edits or 0}'
+
+# Reservations changed in place through the ORM (admin edits) bump the calendar version of
+# their resident, and of the previous resident when the booking moved to someone else
+@event.listens_for(Session, 'after_flush')
+def bump_calendar_versions(db_session, flush_context):
+    user_ids = set()
+    for obj in db_session.dirty:
+        if isinstance(obj, Reservation) and db_session.is_modified(obj, include_collections=False):
+            attrs = inspect(obj).attrs
+            user_ids.add(obj.user_id)
+            user_ids.update(attrs.user_id.history.deleted)
+            user_ids.update(user.id for user in attrs.user.history.deleted if user is not None)
+    user_ids.discard(None)
+    if user_ids:
+        db_session.connection().execute(User.__table__.update().where(User.id.in_(user_ids))
+                                        .values(calendar_version=User.calendar_version + 1))
+
+# Yield the feed line by line while reading reservations in batches, so a long booking
+# history is never built up in memory
+def calendar_lines(user_id):
+    stamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    yield 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Condominium Facility Booking//EN\r\n'
+    yield 'CALSCALE:GREGORIAN\r\nX-WR-CALNAME:My Facility Bookings\r\n'
+    rows = db.session.execute(
+        select(Reservation.id, Reservation.location, Reservation.selected_date,
+               Reservation.start_minute, Reservation.end_minute)
+        .where(Reservation.user_id == user_id).order_by(Reservation.id)
+        .execution_options(yield_per=200))
+    for reservation_id, location, selected_date, start_minute, end_minute in rows:
+        day = selected_date.strftime('%Y%m%d')
+        yield (f'BEGIN:VEVENT\r\nUID:reservation-{reservation_id}@{request.host}\r\nDTSTAMP:{stamp}\r\n'
+               f'DTSTART:{day}T{start_minute // 60:02d}{start_minute % 60:02d}00\r\n'
+               f'DTEND:{day}T{end_minute // 60:02d}{end_minute % 60:02d}00\r\n'
+               f"SUMMARY:{location.replace('_', ' ').title()} booking\r\nEND:VEVENT\r\n")
+    yield 'END:VCALENDAR\r\n'
+
+
+# Move reservations older than the horizon into reservation_archive. Every batch is its own
+# short transaction (copy then delete the same ids), so bookings are never blocked for long.
+def archive_reservations(horizon_days=None, batch_size=None):
+    horizon_days = app.config['ARCHIVE_HORIZON_DAYS'] if horizon_days is None else horizon_days
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    cutoff = date.today() - timedelta(days=horizon_days)
+    columns = ['id', 'user_id', 'username', 'location', 'selected_date', 'start_minute', 'end_minute']
+    archived = 0
+    while True:
+        ids = db.session.execute(
+            select(Reservation.id).where(Reservation.selected_date < cutoff)
+            .order_by(Reservation.selected_date, Reservation.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        connection = db.session.connection()
+        connection.execute(insert(ReservationArchive).from_select(
+            columns + ['archived_at'],
+            select(*[getattr(Reservation, name) for name in columns],
+                   bindparam('archived_at', datetime.now(), type_=db.DateTime))
+            .where(Reservation.id.in_(ids)),
+        ))
+        moved = connection.execute(
+            Reservation.__table__.delete().where(Reservation.id.in_(ids))
+            .returning(Reservation.location, Reservation.selected_date)
+        ).all()
+        db.session.commit()
+        for location, selected_date in set(moved):
+            invalidate_availability(location, selected_date)
+        archived += len(moved)
+    return archived
+
+@app.cli.command('archive-reservations')
+@click.option('--horizon-days', type=int, default=None, help='Archive reservations older than this many days.')
+@click.option('--batch-size', type=int, default=None, help='Rows moved per transaction.')
+def archive_reservations_command(horizon_days, batch_size):
+    print('Archived', archive_reservations(horizon_days, batch_size), 'reservations')
+
+# Run the archive job (and prune dead sessions and rate limit counters) every ARCHIVE_INTERVAL_HOURS in a background
+# thread of each app process, running it from several processes at once is harmless
+archive_scheduler = []
+archive_scheduler_lock = threading.Lock()
+
+# Each job runs on its own, so one failing does not skip the others. The session store and
+# rate limiter are defined further down, hence the lambdas.
+MAINTENANCE_JOBS = [
+    ('Archiving reservations', lambda: archive_reservations()),
+    ('Pruning sessions', lambda: session_store.prune()),
+    ('Pruning rate limit counters', lambda: rate_limiter.prune()),
+]
+
+def run_archive_scheduler():
+    while True:
+        with app.app_context():
+            for job_name, job in MAINTENANCE_JOBS:
+                try:
+                    job()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('%s failed', job_name)
+        time.sleep(app.config['ARCHIVE_INTERVAL_HOURS'] * 3600)
+
+# Start the background jobs of this process on its first request
+@app.before_request
+def start_background_jobs():
+    if archive_scheduler:
+        return
+    with archive_scheduler_lock:
+        if archive_scheduler:
+            return
+        restore_hold_expiries()
+        threading.Thread(target=run_payment_sweeper, name='payment-sweeper', daemon=True).start()
+        if app.config['ARCHIVE_INTERVAL_HOURS']:
+            scheduler = threading.Thread(target=run_archive_scheduler, name='archive-scheduler', daemon=True)
+            scheduler.start()
+        archive_scheduler.append(True)
+
+
+# Hold a place in a slot for HOLD_TTL_SECONDS with one conditional insert. A resident has at
+# most one hold, placing a new one releases the previous one. Returns (token, expires_at),
+# or None when the slot is full or the booking rules would refuse it.
+def _build_hold_statement():
+    location = bindparam('location', type_=db.String)
+    selected_date = bindparam('selected_date', type_=db.Date)
+    start_minute = bindparam('start_minute', type_=db.Integer)
+    return insert(SlotHold).from_select(
+        ['token', 'username', 'location', 'selected_date', 'start_minute', 'expires_at'],
+        select(
+            bindparam('token', type_=db.String),
+            bindparam('username', type_=db.String),
+            location,
+            selected_date,
+            start_minute,
+            bindparam('expires_at', type_=db.DateTime),
+        ).where(
+            _slot_has_room(location, selected_date, start_minute),
+            _within_booking_rules(bindparam('username', type_=db.String), selected_date, start_minute,
+                                  bindparam('end_minute', type_=db.Integer)),
+        ),
+    ).returning(SlotHold.id)
+
+hold_statement = _build_hold_statement()
+
+def place_hold(username, location, selected_date, start_minute):
+    connection = db.session.connection()
+    released = connection.execute(
+        SlotHold.__table__.delete().where(SlotHold.username == username)
+        .returning(SlotHold.location, SlotHold.selected_date, SlotHold.start_minute)
+    ).all()
+    params = booking_params(username, location, selected_date, start_minute)
+    params['token'] = secrets.token_urlsafe(24)
+    params['expires_at'] = params['now'] + timedelta(seconds=app.config['HOLD_TTL_SECONDS'])
+    hold_id = connection.execute(hold_statement, params).scalar()
+    db.session.commit()
+
+    slot_released(released)
+    if hold_id is None:
+        return None
+    invalidate_availability(location, selected_date)
+    hold_scheduler.schedule(params['expires_at'], hold_id)
+    return params['token'], params['expires_at']
+
+def release_hold(username, token):
+    released = db.session.connection().execute(
+        SlotHold.__table__.delete().where(SlotHold.token == token, SlotHold.username == username)
+        .returning(SlotHold.location, SlotHold.selected_date, SlotHold.start_minute)
+    ).all()
+    db.session.commit()
+    slot_released(released)
+    return bool(released)
+
+# Places kept by released holds are free again: refresh availability and offer them to the waitlist
+def slot_released(slots):
+    for location, selected_date, start_minute in set(slots):
+        invalidate_availability(location, selected_date)
+        queue_waitlist_promotion(location, selected_date, start_minute)
+
+# Delete one hold by primary key once it has expired
+def expire_hold(hold_id):
+    released = db.session.connection().execute(
+        SlotHold.__table__.delete().where(SlotHold.id == hold_id, SlotHold.expires_at <= datetime.now())
+        .returning(SlotHold.location, SlotHold.selected_date, SlotHold.start_minute)
+    ).all()
+    db.session.commit()
+    slot_released(released)
+
+# After a restart, drop holds that expired while the app was down and schedule the rest.
+# Both are range scans on the expires_at index.
+def restore_hold_expiries():
+    with app.app_context():
+        released = db.session.connection().execute(
+            SlotHold.__table__.delete().where(SlotHold.expires_at <= datetime.now())
+            .returning(SlotHold.location, SlotHold.selected_date, SlotHold.start_minute)
+        ).all()
+        db.session.commit()
+        slot_released(released)
+        for hold_id, expires_at in db.session.execute(
+                select(SlotHold.id, SlotHold.expires_at).where(SlotHold.expires_at > datetime.now())):
+            hold_scheduler.schedule(expires_at, hold_id)
+
+# Expires holds on time without sweeping the table. Pending expiries sit in a heap ordered by
+# expires_at and one thread sleeps until the earliest one is due. New holds wake it up.
+class HoldExpiryScheduler:
+    def __init__(self):
+        self._heap = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, expires_at, hold_id):
+        with self._condition:
+            heapq.heappush(self._heap, (expires_at, hold_id))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='hold-expiry', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                expires_at, hold_id = self._heap[0]
+                delay = (expires_at - datetime.now()).total_seconds()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+            with app.app_context():
+                try:
+                    expire_hold(hold_id)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Releasing hold %s failed', hold_id)
+
+hold_scheduler = HoldExpiryScheduler()
+
+
+# Add a resident to the end of a slot's waitlist with one INSERT ... SELECT, returns their
+# position or None if they are already waiting for this slot
+def join_waitlist(username, location, selected_date, start_minute):
+    same_slot = (
+        (WaitlistEntry.location == location)
+        & (WaitlistEntry.selected_date == selected_date)
+        & (WaitlistEntry.start_minute == start_minute)
+    )
+    next_position = select(func.coalesce(func.max(WaitlistEntry.position), 0) + 1).where(same_slot).scalar_subquery()
+    already_waiting = select(WaitlistEntry.id).where(same_slot, WaitlistEntry.username == username).exists()
+    statement = insert(WaitlistEntry).from_select(
+        ['username', 'location', 'selected_date', 'start_minute', 'position', 'created_at'],
+        select(
+            bindparam('username', username, type_=db.String),
+            bindparam('location', location, type_=db.String),
+            bindparam('selected_date', selected_date, type_=db.Date),
+            bindparam('start_minute', start_minute, type_=db.Integer),
+            next_position,
+            bindparam('created_at', datetime.now(), type_=db.DateTime),
+        ).where(~already_waiting),
+    ).returning(WaitlistEntry.position)
+    position = db.session.execute(statement).scalar()
+    db.session.commit()
+    # A place may have freed up while the resident was joining
+    queue_waitlist_promotion(location, selected_date, start_minute)
+    return position
+
+# Move residents from the head of a slot's waitlist into the slot while it has room. Each
+# promotion is one transaction: claim the head entry by deleting it, then run the
+# conditional booking insert for that resident. If the slot is full the rollback puts the
+# entry back, so two workers can never promote the same entry or overbook. A resident the
+# booking rules refuse is dropped from the waitlist and told why.
+def promote_waitlist(location, selected_date, start_minute):
+    head_id = (
+        select(WaitlistEntry.id)
+        .where(WaitlistEntry.location == location,
+               WaitlistEntry.selected_date == selected_date,
+               WaitlistEntry.start_minute == start_minute)
+        .order_by(WaitlistEntry.position)
+        .limit(1)
+        .scalar_subquery()
+    )
+    promoted = 0
+    while True:
+        connection = db.session.connection()
+        username = connection.execute(
+            WaitlistEntry.__table__.delete().where(WaitlistEntry.id == head_id).returning(WaitlistEntry.username)
+        ).scalar()
+        if username is None:
+            db.session.rollback()
+            break
+        slot_text = (f"{location.replace('_', ' ')} on {selected_date.strftime('%Y-%m-%d')}, "
+                     f"{format_time_slot(start_minute, SLOT_END_MINUTE[start_minute])}")
+        result = connection.execute(booking_statement, booking_params(username, location, selected_date, start_minute))
+        if result.rowcount == 1:
+            message = f"A place opened up and you have been booked into {slot_text}."
+            record_occupancy(connection, [(location, selected_date, start_minute, 1)])
+            promoted += 1
+        else:
+            reason = booking_refusal(username, location, selected_date, start_minute)
+            if reason == 'full':
+                db.session.rollback()
+                break
+            message = f"A place opened up in {slot_text} but it could not be booked: {refusal_message(reason)}"
+        connection.execute(insert(Notification).values(
+            username=username, message=message, created_at=datetime.now(), is_read=False))
+        db.session.commit()
+
+    if promoted:
+        invalidate_availability(location, selected_date)
+    return promoted
+
+# Slots that may have free places, drained by a background thread so cancellations never wait on promotions
+waitlist_queue = queue.Queue()
+waitlist_worker_lock = threading.Lock()
+waitlist_worker = []
+
+def queue_waitlist_promotion(location, selected_date, start_minute):
+    if location not in app.config['FACILITY_CAPACITY'] or start_minute not in SLOT_END_MINUTE:
+        return
+    waitlist_queue.put((location, selected_date, start_minute))
+    with waitlist_worker_lock:
+        if not waitlist_worker:
+            worker = threading.Thread(target=run_waitlist_worker, name='waitlist-worker', daemon=True)
+            worker.start()
+            waitlist_worker.append(worker)
+
+def run_waitlist_worker():
+    while True:
+        slot = waitlist_queue.get()
+        with app.app_context():
+            try:
+                promote_waitlist(*slot)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Waitlist promotion failed for %s', slot)
+        waitlist_queue.task_done()
+
+
+# Passwords are stored as salted werkzeug hashes. Rows from before hashing still hold the
+# plain password, those are compared in constant time and rehashed at the next login.
+def is_password_hash(value):
+    return value.startswith(('scrypt:', 'pbkdf2:')) and value.count('$') == 2
+
+def password_needs_rehash(value):
+    return not is_password_hash(value) or value.split('$', 1)[0] != app.config['PASSWORD_HASH_METHOD']
+
+def hash_password(password):
+    return generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
+
+def _verify_password(stored, password):
+    if is_password_hash(stored):
+        return check_password_hash(stored, password)
+    return hmac.compare_digest(stored.encode(), password.encode())
+
+# hashlib releases the GIL while hashing, so the hashes run in parallel on a small thread
+# pool. At most a few jobs per thread may queue up, and a request waits for its job only
+# PASSWORD_HASH_TIMEOUT seconds, so a burst of logins cannot tie up every request thread.
+password_pool = ThreadPoolExecutor(max_workers=app.config['PASSWORD_HASH_WORKERS'], thread_name_prefix='password')
+password_jobs = threading.BoundedSemaphore(app.config['PASSWORD_HASH_WORKERS'] * 4)
+
+class PasswordBusy(Exception):
+    pass
+
+def run_password_job(function, *args):
+    timeout = app.config['PASSWORD_HASH_TIMEOUT']
+    if not password_jobs.acquire(timeout=timeout):
+        raise PasswordBusy
+    try:
+        future = password_pool.submit(function, *args)
+    except RuntimeError:
+        password_jobs.release()
+        raise
+    future.add_done_callback(lambda _: password_jobs.release())
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        raise PasswordBusy
+
+# Compared against when no user has the given name, so unknown names take as long to
+# reject as wrong passwords
+missing_user_hash = hash_password(secrets.token_urlsafe(16))
+
+# Find the user with this name and password through the name index, hashing in the pool
+def authenticate(name, password):
+    user = User.query.filter_by(name=name).first()
+    if user is None:
+        run_password_job(_verify_password, missing_user_hash, password)
+        return None
+    return user if run_password_job(_verify_password, user.password, password) else None
+
+# Store the password with the current hash method, the caller commits
+def set_password(user, password):
+    user.password = run_password_job(hash_password, password)
+
+@app.cli.command('bench-login')
+@click.option('--seconds', type=float, default=3.0, help='How long to run each measurement.')
+def bench_login_command(seconds):
+    stored = hash_password('benchmark-password')
+    print('Hash method:', app.config['PASSWORD_HASH_METHOD'])
+    for threads in sorted({1, app.config['PASSWORD_HASH_WORKERS']}):
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            deadline = time.perf_counter() + seconds
+            def verify_until_deadline():
+                count = 0
+                while time.perf_counter() < deadline:
+                    _verify_password(stored, 'benchmark-password')
+                    count += 1
+                return count
+            verified = sum(pool.map(lambda _: verify_until_deadline(), range(threads)))
+        rate = verified / seconds
+        print(f'{threads} thread(s): {rate:.1f} logins/s, {rate / threads:.1f} per thread, '
+              f'{1000 / (rate / threads):.0f} ms per verify')
+
+
+# Sliding window rate limiter shared by all worker processes. Each key counts hits in fixed
+# windows, and the estimate for the sliding window is the current count plus the previous
+# window's count weighted by how much of it still overlaps. The counters are kept in their
+# own WAL-mode SQLite file with synchronous off, so counting never waits on the app database
+# and losing the last counts in a crash does not matter. Keys found over their limit are also
+# remembered by the worker until their block ends, and further attempts are refused at once.
+class SlidingWindowLimiter:
+    def __init__(self, path):
+        self.path = path
+        self.blocked = TTLCache(maxsize=10000, ttl=max(window for _, window in app.config['RATE_LIMITS'].values()))
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS hits (key TEXT NOT NULL, window INTEGER NOT NULL, '
+                               'count INTEGER NOT NULL, expires REAL NOT NULL, PRIMARY KEY (key, window)) WITHOUT ROWID')
+            self._local.connection = connection
+        return connection
+
+    # Count one attempt for key, returns 0 when it is allowed or the seconds to wait
+    def hit(self, key, limit, window):
+        now = time.time()
+        blocked_until = self.blocked.get(key)
+        if blocked_until and blocked_until > now:
+            return blocked_until - now
+
+        current = int(now // window)
+        connection = self._connection()
+        count = connection.execute(
+            'INSERT INTO hits (key, window, count, expires) VALUES (?, ?, 1, ?) '
+            'ON CONFLICT (key, window) DO UPDATE SET count = count + 1 RETURNING count',
+            (key, current, (current + 2) * window)).fetchone()[0]
+        previous = connection.execute('SELECT count FROM hits WHERE key = ? AND window = ?',
+                                      (key, current - 1)).fetchone()
+        overlap = 1 - (now % window) / window
+        if count + (previous[0] if previous else 0) * overlap <= limit:
+            return 0
+        blocked_until = (current + 1) * window
+        self.blocked.set(key, blocked_until)
+        return blocked_until - now
+
+    def prune(self):
+        return self._connection().execute('DELETE FROM hits WHERE expires < ?', (time.time(),)).rowcount
+
+rate_limiter = SlidingWindowLimiter(app.config['RATE_LIMIT_DB'])
+
+@app.cli.command('prune-rate-limits')
+def prune_rate_limits_command():
+    print('Removed', rate_limiter.prune(), 'expired rate limit counters')
+
+# Seconds the client has to wait before trying again, 0 when every rule allows the attempt
+def rate_limited(**keys):
+    waits = []
+    for rule, key in keys.items():
+        limit, window = app.config['RATE_LIMITS'][rule]
+        waits.append(rate_limiter.hit(f'{rule}:{key}', limit, window))
+    return max(waits)
+
+def too_many_attempts(template, wait):
+    message = f'Too many attempts, please try again in {int(wait) + 1} seconds.'
+    return render_template(template, message=message), 429, {'Retry-After': str(int(wait) + 1)}
+
+@app.cli.command('bench-limiter')
+@click.option('--count', type=int, default=20000, help='Attempts to time for each case.')
+def bench_limiter_command(count):
+    key = secrets.token_hex(8)
+    cases = [('allowed', f'bench-allowed-{key}', count + 1), ('blocked', f'bench-blocked-{key}', 0)]
+    for case, bench_key, limit in cases:
+        rate_limiter.hit(bench_key, limit, 3600)
+        started = time.perf_counter()
+        for _ in range(count):
+            rate_limiter.hit(bench_key, limit, 3600)
+        elapsed = time.perf_counter() - started
+        print(f'{case}: {elapsed / count * 1e6:.1f} us per attempt')
+
+
+# Bulk onboarding of residents from a CSV file with a header row naming the columns below.
+# The file is read a chunk of rows at a time: each chunk is validated, checked against the
+# existing users with indexed IN lookups, hashed on a process pool and inserted with one
+# executemany. Rejected rows go to an error CSV, without their password, with the reason.
+RESIDENT_CSV_FIELDS = ('name', 'email', 'password', 'unit_number')
+RESIDENT_UNIQUE_FIELDS = ('name', 'email', 'unit_number')
+RESIDENT_FIELD_LENGTHS = {'name': 100, 'email': 120, 'unit_number': 20}
+EMAIL_PATTERN = re.compile(r'[^@\s]+@[^@\s]+')
+
+def resident_row_error(row):
+    for field in RESIDENT_CSV_FIELDS:
+        if not row[field]:
+            return f'{field} is missing'
+    for field, length in RESIDENT_FIELD_LENGTHS.items():
+        if len(row[field]) > length:
+            return f'{field} is longer than {length} characters'
+    if not EMAIL_PATTERN.fullmatch(row['email']):
+        return 'email is not a valid address'
+    return None
+
+def parse_resident_row(line_number, row):
+    return line_number, {field: (row.get(field) or '').strip() for field in RESIDENT_CSV_FIELDS}
+
+def import_residents(lines, errors, chunk_size=None, workers=None, progress=None):
+    reader = csv.DictReader(lines)
+    missing = set(RESIDENT_CSV_FIELDS) - set(reader.fieldnames or ())
+    if missing:
+        raise ValueError(f"The CSV has no {', '.join(sorted(missing))} column")
+
+    error_writer = csv.writer(errors)
+    error_writer.writerow(['line', 'name', 'email', 'unit_number', 'error'])
+    def reject(line, row, error):
+        error_writer.writerow([line, row['name'], row['email'], row['unit_number'], error])
+
+    seen = {field: set() for field in RESIDENT_UNIQUE_FIELDS}
+    imported = rejected = 0
+    hash_password_with_method = partial(generate_password_hash, method=app.config['PASSWORD_HASH_METHOD'])
+    workers = workers or app.config['IMPORT_HASH_WORKERS']
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in read_csv_chunks(reader, chunk_size or app.config['IMPORT_CHUNK_SIZE'], parse_resident_row):
+            taken = {}
+            for field in RESIDENT_UNIQUE_FIELDS:
+                column = getattr(User, field)
+                taken[field] = set(db.session.execute(
+                    select(column).where(column.in_({row[field] for _, row in chunk}))).scalars())
+
+            valid = []
+            for line, row in chunk:
+                error = resident_row_error(row)
+                for field in RESIDENT_UNIQUE_FIELDS:
+                    if error:
+                        break
+                    if row[field] in taken[field]:
+                        error = f'{field} is already registered'
+                    elif row[field] in seen[field]:
+                        error = f'{field} appears earlier in the file'
+                if error:
+                    reject(line, row, error)
+                    rejected += 1
+                    continue
+                for field in RESIDENT_UNIQUE_FIELDS:
+                    seen[field].add(row[field])
+                valid.append((line, row))
+
+            passwords = [row['password'] for _, row in valid]
+            hashes = pool.map(hash_password_with_method, passwords, chunksize=max(1, len(passwords) // (workers * 4)))
+            users = [{'name': row['name'], 'email': row['email'], 'unit_number': row['unit_number'], 'password': hashed}
+                     for (_, row), hashed in zip(valid, hashes)]
+            if users:
+                try:
+                    db.session.execute(insert(User), users)
+                    db.session.commit()
+                    imported += len(users)
+                except IntegrityError:
+                    # Someone signed up with the same details meanwhile, find them row by row
+                    db.session.rollback()
+                    for (line, row), user in zip(valid, users):
+                        try:
+                            db.session.execute(insert(User), user)
+                            db.session.commit()
+                            imported += 1
+                        except IntegrityError as error:
+                            db.session.rollback()
+                            reject(line, row, duplicate_user_message(error))
+                            rejected += 1
+            if progress:
+                progress(reader.line_num, imported, rejected)
+    return imported, rejected
+
+@app.cli.command('import-residents')
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--errors', 'error_path', default='rejected_residents.csv', help='Where rejected rows are written.')
+@click.option('--chunk-size', type=int, default=None, help='Residents inserted per statement.')
+@click.option('--workers', type=int, default=None, help='Processes hashing passwords.')
+def import_residents_command(csv_path, error_path, chunk_size, workers):
+    def progress(line, imported, rejected):
+        print(f'Line {line}: {imported} imported, {rejected} rejected')
+    with open(csv_path, newline='', encoding='utf-8-sig') as lines, open(error_path, 'w', newline='') as errors:
+        imported, rejected = import_residents(lines, errors, chunk_size, workers, progress)
+    print('Imported', imported, 'residents,', rejected, 'rejected' + (f', see {error_path}' if rejected else ''))
+
+# Imports started from the admin page, by job id
+resident_imports = TTLCache(maxsize=100, ttl=24 * 3600)
+
+def start_resident_import(upload):
+    job_id = secrets.token_hex(8)
+    error_fd, error_path = tempfile.mkstemp(suffix='.csv')
+    os.close(error_fd)
+
+    def import_upload(lines, job):
+        def progress(line, imported, rejected):
+            job.update(line=line, imported=imported, rejected=rejected)
+        with open(error_path, 'w', newline='') as errors:
+            import_residents(lines, errors, progress=progress)
+
+    start_upload_job(resident_imports, job_id, upload, {'imported': 0, 'rejected': 0, 'error_path': error_path},
+                     import_upload, 'Importing residents')
+    return job_id
+
+
+# Server-side sessions. The cookie only carries an opaque random id, the session data
+# (the signed-in user's id) lives in the store under that id. The store
+# below keeps sessions in the app database so every worker process sees the same ones;
+# a networked store such as Redis only has to provide the same load, save, delete and
+# revoke methods. Each worker keeps recently used sessions in an LRU cache in front of it.
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.new = sid is None
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.expires_at = expires_at
+        self.replaced_sid = None
+        self.modified = False
+
+    # Give the session a new id (on login), the old id stops working
+    def rotate(self):
+        if not self.new:
+            self.replaced_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+class SQLiteSessionStore:
+    def __init__(self, cache):
+        self.cache = cache
+        self.table = UserSession.__table__
+
+    # Statements run on the request's own db.session, so saving a session at the end of a
+    # request reuses the connection the request already holds instead of taking a second one
+    # from the pool. Every view commits its own work, so whatever is still pending here was
+    # left by a request that failed part way and is rolled back rather than committed with
+    # the session.
+    def _session(self):
+        db.session.rollback()
+        return db.session
+
+    # Returns (data, expires_at) or None for a missing, expired or revoked session
+    def load(self, sid):
+        entry = self.cache.get(sid)
+        if entry is None:
+            entry = self._session().execute(
+                select(self.table.c.data, self.table.c.expires_at)
+                .where(self.table.c.id == sid, self.table.c.revoked.is_(False))).first()
+            if entry is None:
+                return None
+            entry = tuple(entry)
+            self.cache.set(sid, entry)
+        data, expires_at = entry
+        if expires_at <= datetime.now():
+            self.cache.pop(sid)
+            return None
+        return data, expires_at
+
+    def save(self, sid, user_id, data, expires_at):
+        db_session = self._session()
+        db_session.execute(sqlite_insert(self.table).values(
+            id=sid, user_id=user_id, data=data, created_at=datetime.now(),
+            expires_at=expires_at, revoked=False,
+        ).on_conflict_do_update(index_elements=['id'], set_={
+            'user_id': user_id, 'data': data, 'expires_at': expires_at}))
+        db_session.commit()
+        self.cache.set(sid, (data, expires_at))
+
+    def delete(self, sid):
+        db_session = self._session()
+        db_session.execute(self.table.delete().where(self.table.c.id == sid))
+        db_session.commit()
+        self.cache.pop(sid)
+
+    # Revoke sessions by id, or every session of a user except the one to keep
+    def revoke(self, sids=None, user_id=None, keep=None):
+        statement = self.table.update().values(revoked=True).returning(self.table.c.id)
+        if sids is not None:
+            statement = statement.where(self.table.c.id.in_(sids))
+        else:
+            statement = statement.where(self.table.c.user_id == user_id, self.table.c.id != keep)
+        db_session = self._session()
+        revoked = db_session.execute(statement).scalars().all()
+        db_session.commit()
+        for sid in revoked:
+            self.cache.pop(sid)
+        return len(revoked)
+
+    def prune(self):
+        db_session = self._session()
+        pruned = db_session.execute(self.table.delete().where(
+            or_(self.table.c.expires_at <= datetime.now(), self.table.c.revoked.is_(True)))).rowcount
+        db_session.commit()
+        return pruned
+
+class ServerSideSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        stored = self.store.load(sid) if sid else None
+        if stored is None:
+            return ServerSession()
+        data, expires_at = stored
+        return ServerSession(self.serializer.loads(data), sid=sid, expires_at=expires_at)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.replaced_sid:
+            self.store.delete(session.replaced_sid)
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # Unchanged sessions are only written again once half their lifetime has passed. The
+        # stored session always expires after the lifetime, the cookie only does for permanent
+        # sessions and otherwise ends with the browser session.
+        lifetime = app.permanent_session_lifetime
+        now = datetime.now()
+        if not session.modified and session.expires_at - now > lifetime / 2:
+            return
+        session.expires_at = now + lifetime
+        self.store.save(session.sid, session.get('user_id'), self.serializer.dumps(dict(session)),
+                        session.expires_at)
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            domain=domain, path=path, httponly=self.get_cookie_httponly(app),
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+session_store = SQLiteSessionStore(TTLCache(maxsize=app.config['SESSION_CACHE_SIZE'],
+                                            ttl=app.config['SESSION_CACHE_TTL']))
+app.session_interface = ServerSideSessionInterface(session_store)
+
+@app.cli.command('prune-sessions')
+def prune_sessions_command():
+    print('Removed', session_store.prune(), 'expired or revoked sessions')
+
+
+# The signed-in user is loaded once per request into g.user. Records are cached per worker
+# by user id and dropped whenever the ORM updates or deletes that user, so pages only read
+# the user table after an edit or when the cache entry has expired.
+CurrentUser = namedtuple('CurrentUser', 'id name email unit_number calendar_token')
+user_cache = TTLCache(maxsize=4096, ttl=app.config['USER_CACHE_TTL'])
+
+def load_user(user_id):
+    user = user_cache.get(user_id)
+    if user is None:
+        row = db.session.execute(
+            select(User.id, User.name, User.email, User.unit_number, User.calendar_token).where(User.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        user = CurrentUser(*row)
+        user_cache.set(user_id, user)
+    return user
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_cached_user(mapper, connection, target):
+    user_cache.pop(target.id)
+
+# A session whose user has been deleted is signed out
+@app.before_request
+def load_current_user():
+    g.user = None
+    user_id = session.get('user_id')
+    if user_id is not None:
+        g.user = load_user(user_id)
+        if g.user is None:
+            session.clear()
+
+# Send visitors who are not signed in to the login page
+def login_required(view):
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if g.user is None:
+            return redirect(url_for('login'))
+        return view(*args, **kwargs)
+    return wrapped
+
+# JSON routes answer 401 instead of redirecting to the login page
+def api_login_required(view):
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if g.user is None:
+            return jsonify(error='Login required.'), 401
+        return view(*args, **kwargs)
+    return wrapped
 
 
 @app.route('/')
+@login_required
 def index():
-    if 'username' in session:
-        return render_template('index.html', username=session['username'])
-    return redirect(url_for('login'))
+    username = g.user.name
+    notifications = Notification.query.filter_by(username=username, is_read=False).order_by(Notification.id).all()
+    if notifications:
+        Notification.query.filter(Notification.id.in_([n.id for n in notifications])).update(
+            {Notification.is_read: True}, synchronize_session=False)
+        db.session.commit()
+    return render_template('index.html', username=username, notifications=notifications)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -99,17 +2794,47 @@ def login():
         name = request.form['name']
         password = request.form['password']
 
+        # Refuse throttled clients and names before any database or hashing work
+        wait = rate_limited(login_ip=request.remote_addr, login_name=name.strip().lower())
+        if wait:
+            return too_many_attempts('login.html', wait)
+
         # Check if the user with the given name and password exists
-        user = User.query.filter_by(name=name, password=password).first()
+        try:
+            user = authenticate(name, password)
+        except PasswordBusy:
+            return render_template('login.html', message='Too many sign-ins right now, please try again.'), 503
 
         if user:
-            session['username'] = name
+            # Upgrade a plain or outdated password hash now that the password is known. The
+            # password is already verified, so a busy pool only postpones the upgrade.
+            if password_needs_rehash(user.password):
+                try:
+                    set_password(user, password)
+                    db.session.commit()
+                except PasswordBusy:
+                    pass
+            session.rotate()
+            session['user_id'] = user.id
             return redirect(url_for('index'))
         else:
             message = 'Incorrect name or password'
 
     return render_template('login.html', message=message)
 
+# SQLite names the first unique column a new user clashed on, e.g. UNIQUE constraint failed: user.email
+DUPLICATE_USER_MESSAGES = {
+    'user.name': 'That name is already registered. Please use a different name.',
+    'user.email': 'That email is already registered. Please use a different email.',
+    'user.unit_number': 'That unit already has an account. Please check the unit number.',
+}
+
+def duplicate_user_message(error):
+    for column, message in DUPLICATE_USER_MESSAGES.items():
+        if column in str(error.orig):
+            return message
+    return 'User with the provided information already exists. Please use different information.'
+
 @app.route('/signup', methods=['GET', 'POST'])
 def signup():
     if request.method == 'POST':
@@ -118,18 +2843,23 @@ def signup():
         password = request.form['password']
         unit_number = request.form['unit_number']
 
-        # Check if any user with the provided data already exists
-        existing_user = User.query.filter(
-            (User.name == name) | (User.email == email) | (User.unit_number == unit_number)
-        ).first()
-
-        if existing_user:
-            return render_template('signup.html', message='User with the provided information already exists. Please use different information.')
+        wait = rate_limited(signup_ip=request.remote_addr)
+        if wait:
+            return too_many_attempts('signup.html', wait)
 
-        # Create a new user if the provided data doesn't exist
-        new_user = User(name=name, email=email, password=password, unit_number=unit_number)
+        # Create the user straight away, the unique indexes on name, email and unit number
+        # reject anything already registered and say which field clashed
+        new_user = User(name=name, email=email, unit_number=unit_number)
+        try:
+            set_password(new_user, password)
+        except PasswordBusy:
+            return render_template('signup.html', message='Too many sign-ups right now, please try again.'), 503
         db.session.add(new_user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            return render_template('signup.html', message=duplicate_user_message(error)), 409
         return redirect(url_for('login'))
 
     return render_template('signup.html')
@@ -137,29 +2867,33 @@ def signup():
 
 @app.route('/logout')
 def logout():
-    session.pop('username', None)
+    session.clear()
     return redirect(url_for('login'))
 
 @app.route('/change_password', methods=['GET', 'POST'])
+@login_required
 def change_password():
-    if 'username' not in session:
-        return redirect(url_for('login'))
-
     message = ''
     if request.method == 'POST':
-        username = session['username']
         old_password = request.form['old_password']
         new_password = request.form['new_password']
 
         # Retrieve the user from the database
-        user = User.query.filter_by(name=username, password=old_password).first()
+        user = db.session.get(User, g.user.id)
+        try:
+            if not run_password_job(_verify_password, user.password, old_password):
+                user = None
+            if user:
+                # Update the password
+                set_password(user, new_password)
+        except PasswordBusy:
+            return render_template('change_password.html', message='Too many requests right now, please try again.'), 503
 
         if user:
-            # Update the password
-            user.password = new_password
-
             # Commit changes to the database
             db.session.commit()
+            # Sign out every other session of this user
+            session_store.revoke(user_id=user.id, keep=session.sid)
             message = 'Password changed successfully!'
         else:
             message = 'Failed to change password, please try again.'
@@ -168,17 +2902,15 @@ def change_password():
 
 @app.route('/selection')
 def selection():
-    return render_template('Selection.html')
+    return render_template('Selection.html', time_slots=TIME_SLOTS, max_weeks=app.config['MAX_RECURRING_WEEKS'])
 
 @app.route('/payment')
 def paymentoption():
     return render_template('PaymentOption.html')
 
 @app.route('/process_selection', methods=['POST'])
+@login_required
 def process_selection():
-    if 'username' not in session:
-        return redirect(url_for('login'))
-
     # Safely get the 'activity' value from the form data
     location = request.form.get('activity')
     # Check if the activity was provided
@@ -188,14 +2920,22 @@ def process_selection():
         flash("Please select an activity.", "error")
         return redirect(url_for('selection'))
 
+    if location not in app.config['FACILITY_CAPACITY']:
+        flash("Unknown activity.", "error")
+        return redirect(url_for('selection'))
+
     selected_date = request.form.get('selected_date')
-    selected_time = request.form.get('selected_time')
-    
+    start_minute = request.form.get('start_minute', type=int)
+
     # Ensure all fields are filled, otherwise, redirect back
-    if not all([selected_date, selected_time]):
+    if not all([selected_date, start_minute is not None]):
         flash("All fields are required.", "error")
         return redirect(url_for('selection'))
 
+    if start_minute not in SLOT_END_MINUTE:
+        flash("Invalid time slot.", "error")
+        return redirect(url_for('selection'))
+
     # Convert the date string to a date object
     try:
         selected_date = datetime.strptime(selected_date, '%Y-%m-%d').date()
@@ -203,14 +2943,47 @@ def process_selection():
         flash("Invalid date format.", "error")
         return redirect(url_for('selection'))
 
-    username = session['username']
-    
-    # Create a new reservation
-    reservation = Reservation(username=username, location=location, selected_date=selected_date, selected_time=selected_time)
+    username = g.user.name
+    hold_token = request.form.get('hold_token')
 
-    # Add the reservation to the database
-    db.session.add(reservation)
-    db.session.commit()
+    # Book a weekly pattern when the resident asked for more than one week or extra weekdays
+    repeat_weeks = request.form.get('repeat_weeks', 1, type=int)
+    repeat_days = [day for day in request.form.getlist('repeat_days', type=int) if 0 <= day <= 6]
+    if repeat_weeks > 1 or repeat_days:
+        if not 1 <= repeat_weeks <= app.config['MAX_RECURRING_WEEKS']:
+            flash("Invalid number of weeks.", "error")
+            return redirect(url_for('selection'))
+
+        dates = recurring_dates(selected_date, repeat_days or [selected_date.weekday()], repeat_weeks)
+        if not dates:
+            flash("No dates match this pattern, choose weekdays on or after the start date or more weeks.", "error")
+            return redirect(url_for('selection'))
+        if hold_token:
+            release_hold(username, hold_token)
+        booked, failed = book_recurring(username, location, start_minute, dates,
+                                        allow_partial=bool(request.form.get('allow_partial')))
+        failed_text = ', '.join(day.strftime('%Y-%m-%d') for day in failed)
+        if not booked:
+            flash(f"Nothing was booked, these dates are full or over your booking limits: {failed_text}", "error")
+            return redirect(url_for('selection'))
+        if failed:
+            flash(f"Booked {len(booked)} sessions. These dates are full or over your booking limits: {failed_text}",
+                  "error")
+        return redirect(url_for('slot_summary'))
+
+    # Create a new reservation if the slot still has room
+    if not book_slot(username, location, selected_date, start_minute, hold_token):
+        reason = booking_refusal(username, location, selected_date, start_minute)
+        if reason == 'full' and request.form.get('join_waitlist'):
+            position = join_waitlist(username, location, selected_date, start_minute)
+            if position is None:
+                flash("This time slot is fully booked and you are already on its waitlist.", "error")
+            else:
+                flash(f"This time slot is fully booked. You are number {position} on the waitlist "
+                      "and will be booked automatically when a place opens up.", "info")
+        else:
+            flash(refusal_message(reason), "error")
+        return redirect(url_for('selection'))
 
     # Redirect to slot_summary page with reservation details
     return redirect(url_for('slot_summary'))
@@ -218,28 +2991,170 @@ def process_selection():
 
 # Modify the slot_summary route to handle the latest or a specific reservation
 @app.route('/slot_summary')
+@login_required
 def slot_summary():
-    if 'username' not in session:
-        return redirect(url_for('login'))
-
-    username = session['username']
-    reservation = Reservation.query.filter_by(username=username).order_by(Reservation.id.desc()).first()
+    username = g.user.name
+    reservation = Reservation.query.filter_by(user_id=g.user.id).order_by(Reservation.id.desc()).first()
 
     if reservation:
         return render_template('slot_summary.html', username=username, reservation=reservation)
     else:
         return "No reservation found for this user."
 
+@app.route('/reservations')
+@login_required
+def reservation_history():
+    scope = 'past' if request.args.get('scope') == 'past' else 'upcoming'
+    reservations, next_cursor = reservation_page(
+        g.user.name, scope, parse_history_cursor(request.args.get('after')))
+    return render_template('reservation_history.html', reservations=reservations, scope=scope,
+                           next_cursor=next_cursor, calendar_token=calendar_token_for(g.user))
+
+# Subscription feed for calendar apps. A poll whose ETag still matches is answered with
+# 304 after one index lookup, the reservations themselves are only read when they changed.
+@app.route('/calendar/<token>.ics')
+def calendar_feed(token):
+    user_id = calendar_owner(token)
+    if user_id is None:
+        return 'Unknown calendar.', 404
+
+    etag = calendar_etag(user_id)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(stream_with_context(calendar_lines(user_id)), mimetype='text/calendar')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/holds', methods=['POST'])
+@api_login_required
+def create_hold():
+
+    location = request.form.get('location')
+    start_minute = request.form.get('start_minute', type=int)
+    try:
+        selected_date = datetime.strptime(request.form.get('selected_date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify(error='selected_date must be a date in YYYY-MM-DD format.'), 400
+    if location not in app.config['FACILITY_CAPACITY'] or start_minute not in SLOT_END_MINUTE:
+        return jsonify(error='Unknown location or time slot.'), 400
+
+    hold = place_hold(g.user.name, location, selected_date, start_minute)
+    if hold is None:
+        reason = booking_refusal(g.user.name, location, selected_date, start_minute)
+        return jsonify(error=refusal_message(reason), reason=reason), 409
+    token, expires_at = hold
+    return jsonify(token=token, expires_at=expires_at.isoformat(timespec='seconds')), 201
+
+@app.route('/api/holds/<token>', methods=['DELETE'])
+@api_login_required
+def delete_hold(token):
+
+    if not release_hold(g.user.name, token):
+        return jsonify(error='Hold not found.'), 404
+    return '', 204
+
+@app.route('/api/reservations')
+@api_login_required
+def reservation_history_api():
+
+    scope = request.args.get('scope', 'upcoming')
+    if scope not in ('upcoming', 'past'):
+        return jsonify(error='scope must be upcoming or past.'), 400
+    cursor = parse_history_cursor(request.args.get('after'))
+    if request.args.get('after') and cursor is None:
+        return jsonify(error='Invalid cursor.'), 400
+
+    reservations, next_cursor = reservation_page(g.user.name, scope, cursor)
+    return jsonify(scope=scope, next_cursor=next_cursor, reservations=[{
+        'id': reservation.id,
+        'location': reservation.location,
+        'date': reservation.selected_date.strftime('%Y-%m-%d'),
+        'start_minute': reservation.start_minute,
+        'end_minute': reservation.end_minute,
+        'time': reservation.selected_time,
+    } for reservation in reservations])
+
+@app.route('/cancel_reservation/<int:reservation_id>', methods=['POST'])
+@login_required
+def cancel_reservation(reservation_id):
+    reservation = Reservation.query.filter_by(id=reservation_id, username=g.user.name).first()
+    if reservation:
+        # Deleting through the session also refreshes the cached availability for this slot
+        db.session.delete(reservation)
+        db.session.commit()
+        flash("Your reservation has been cancelled.", "info")
+
+    return redirect(url_for('selection'))
+
+@app.route('/api/availability')
+@api_login_required
+def availability():
+
+    location = request.args.get('location')
+    if location not in app.config['FACILITY_CAPACITY']:
+        return jsonify(error='Unknown location.'), 400
+
+    try:
+        start = datetime.strptime(request.args['from'], '%Y-%m-%d').date()
+        end = datetime.strptime(request.args.get('to', request.args['from']), '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return jsonify(error='from and to must be dates in YYYY-MM-DD format.'), 400
+
+    if end < start or (end - start).days >= app.config['AVAILABILITY_MAX_DAYS']:
+        return jsonify(error='Invalid date range.'), 400
+
+    return jsonify(location=location, slots=get_availability(location, start, end))
+
+# E-wallets residents can pay with, by the value their payment form sends
+EWALLETS = {'tng': "Touch 'n Go", 'grabpay': 'GrabPay', 'boost': 'Boost', 'shopeepay': 'ShopeePay'}
+
 @app.route('/ewalletoption')
 def ewalletoption():
-    return render_template('EWalletOption.html')
+    return render_template('EWalletOption.html', ewallets=EWALLETS, idempotency_key=secrets.token_urlsafe(16))
+
+# Same intent flow as /submit, with the chosen e-wallet as the payment source
+@app.route('/ewallet_submit', methods=['POST'])
+@login_required
+def ewallet_submit():
+    idempotency_key = request.form.get('idempotency_key', '')
+    if not 16 <= len(idempotency_key) <= 64:
+        return render_template('EWalletOption.html', ewallets=EWALLETS, idempotency_key=secrets.token_urlsafe(16),
+                               errors=['The payment form has expired, please choose your e-wallet again.'])
+    intent = find_payment_intent(g.user.id, idempotency_key)
+    if intent:
+        return render_template('PaymentProcessing.html', intent=intent)
+
+    errors = []
+    wallet = request.form.get('wallet')
+    if wallet not in EWALLETS:
+        errors.append("Please choose an e-wallet.")
+    amount = resident_balance(g.user.id)
+    if amount <= 0:
+        errors.append("You have no outstanding fees to pay.")
+    if errors:
+        return render_template('EWalletOption.html', ewallets=EWALLETS, idempotency_key=idempotency_key, errors=errors)
+
+    intent = create_payment_intent(g.user.id, idempotency_key, amount, 'ewallet', f'ewallet_{wallet}')
+    return render_template('PaymentProcessing.html', intent=intent), 202
 
+# Every payment form gets a fresh idempotency key, resubmitting that form reuses its intent
 @app.route('/onlinebanking')
 def onlinebanking():
-    return render_template('OnlineBanking.html')
+    return render_template('OnlineBanking.html', idempotency_key=secrets.token_urlsafe(16))
 
 @app.route('/submit', methods=['POST'])
+@login_required
 def submit():
+    idempotency_key = request.form.get('idempotency_key', '')
+    if not 16 <= len(idempotency_key) <= 64:
+        return render_template('OnlineBanking.html', idempotency_key=secrets.token_urlsafe(16),
+                               errors=['The payment form has expired, please enter your card again.'])
+    intent = find_payment_intent(g.user.id, idempotency_key)
+    if intent:
+        return render_template('PaymentProcessing.html', intent=intent)
+
     card_number = request.form['card_number'].replace(" ", "")
     cvc = request.form['cvc']
     expiration_month = request.form['expiration_month']
@@ -254,38 +3169,63 @@ def submit():
         errors.append("Please enter a valid 3-digit CVC.")
 
     current_year = int(str(date.today().year)[-2:])
-    if len(expiration_year) != 2 or int(expiration_year) <= current_year:
+    if len(expiration_year) != 2 or not expiration_year.isdigit() or int(expiration_year) <= current_year:
         errors.append("Please enter a valid expiration year (YY) that is greater than the current year.")
 
     if len(expiration_month) != 2 or not expiration_month.isdigit() or not (1 <= int(expiration_month) <= 12):
         errors.append("Please enter a valid 2-digit month (MM) between 01 and 12.")
  
+    amount = resident_balance(g.user.id)
+    if amount <= 0:
+        errors.append("You have no outstanding fees to pay.")
+
     if errors:
-        return render_template('OnlineBanking.html', errors=errors)
-    else:
-        return render_template(('PaymentSuccessful.html'))
-    
+        return render_template('OnlineBanking.html', idempotency_key=idempotency_key, errors=errors)
+
+    intent = create_payment_intent(g.user.id, idempotency_key, amount, 'card', f'card_{card_number[-4:]}')
+    return render_template('PaymentProcessing.html', intent=intent), 202
+
+# Polled by the payment page until the intent has succeeded or failed
+@app.route('/api/payment_intents/<idempotency_key>')
+@api_login_required
+def payment_intent_status(idempotency_key):
+
+    intent = db.session.execute(
+        select(PaymentIntent.status, PaymentIntent.amount, PaymentIntent.error)
+        .where(PaymentIntent.user_id == g.user.id, PaymentIntent.idempotency_key == idempotency_key)
+    ).first()
+    if intent is None:
+        return jsonify(error='Unknown payment.'), 404
+    return jsonify(status=intent.status, amount=str(intent.amount), error=intent.error)
+
 @app.route('/success')
 def success():
     return render_template('PaymentSuccessful.html')
 
 @app.route('/outstandingfees')
+@login_required
 def outstandingfees():
-    if 'username' not in session:
-        return redirect(url_for('login'))
+    username = g.user.name
+
+    # Query one page of outstanding payments for the current user, with the totals
+    entries, next_cursor = payment_ledger_page(g.user.id, parse_history_cursor(request.args.get('after')))
+    grand_total = resident_balance(g.user.id)
 
-    username = session['username']
-    
-    # Query outstanding payments for the current user
-    outstanding_payments = Payment.query.filter_by(name=username).all()
+    return render_template('OutstandingFees.html', username=username, entries=entries, next_cursor=next_cursor,
+                           grand_total=grand_total)
 
-    return render_template('OutstandingFees.html', outstanding_payments=outstanding_payments)
+# Fee totals only, for dashboard widgets
+@app.route('/api/outstandingfees')
+@api_login_required
+def outstandingfees_api():
+
+    count, months = payment_ledger_totals(g.user.id)
+    return jsonify(total=str(resident_balance(g.user.id)), count=count, months=[
+        {'month': row.month, 'count': row.count, 'total': str(row.total)} for row in months])
 
 @app.route('/announcements')
+@login_required
 def announcements():
-    if 'username' not in session:
-        return redirect(url_for('login'))
-
     # Fetch announcements from the database using SQLAlchemy
     announcements = Announcement.query.order_by(Announcement.announcement_date.desc()).all()
 
@@ -0,0 +1,119 @@
+# Stand-in payment gateway for local load tests. It answers the calls HTTPGateway in app.py
+# makes (POST /authorize and /capture) plus /refund, with configurable latency, error rate,
+# decline rate and hanging requests. Point the app at it with
+#   python gateway_sim.py --port 8081 --latency-ms 120 --error-rate 0.02
+#   FLASK_PAYMENT_GATEWAY=http://127.0.0.1:8081 flask run
+# Every call carries an idempotency key and a repeated key gets the first response again,
+# like a real gateway. Sources ending in 0002 are always declined.
+import argparse
+import json
+import random
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Gateway:
+    def __init__(self, options):
+        self.options = options
+        self.authorizations = {}
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    # Lognormal latency around the median, the usual shape of network and processor delays
+    def delay(self):
+        if self.options.latency_ms > 0:
+            time.sleep(random.lognormvariate(0, self.options.latency_sigma) * self.options.latency_ms / 1000)
+
+    def authorize(self, payload):
+        if payload['source'].endswith('0002') or random.random() < self.options.decline_rate:
+            return {'id': None, 'status': 'declined', 'reason': 'The card was declined.'}
+        authorization_id = 'auth_' + secrets.token_hex(8)
+        self.authorizations[authorization_id] = {'amount_cents': payload['amount_cents'], 'status': 'authorized'}
+        return {'id': authorization_id, 'status': 'authorized'}
+
+    def capture(self, payload):
+        authorization = self.authorizations.get(payload['authorization_id'])
+        if authorization is None or authorization['status'] != 'authorized':
+            return {'status': 'failed', 'reason': 'No authorization to capture.'}
+        authorization['status'] = 'captured'
+        return {'status': 'captured'}
+
+    def refund(self, payload):
+        authorization = self.authorizations.get(payload['authorization_id'])
+        if authorization is None or authorization['status'] != 'captured':
+            return {'status': 'failed', 'reason': 'Nothing captured to refund.'}
+        authorization['status'] = 'refunded'
+        return {'status': 'refunded'}
+
+    # Returns (http status, body). Injected errors are not remembered, so a retry can succeed.
+    def handle(self, action, payload):
+        self.delay()
+        if random.random() < self.options.timeout_rate:
+            time.sleep(self.options.timeout_seconds)
+            return 504, {'error': 'Gateway timeout.'}
+        if random.random() < self.options.error_rate:
+            return 503, {'error': 'Gateway unavailable.'}
+        key = (action, payload['idempotency_key'])
+        with self.lock:
+            if key not in self.responses:
+                self.responses[key] = getattr(self, action)(payload)
+            return 200, self.responses[key]
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    actions = {'/authorize': 'authorize', '/capture': 'capture', '/refund': 'refund'}
+
+    def do_POST(self):
+        action = self.actions.get(self.path)
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            payload['idempotency_key']
+        except (ValueError, KeyError, TypeError):
+            action = None
+        if action is None:
+            status, body = 400, {'error': 'Unknown call or malformed request.'}
+        else:
+            try:
+                status, body = self.server.gateway.handle(action, payload)
+            except KeyError as error:
+                status, body = 400, {'error': f'Missing field {error}.'}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local payment gateway simulator.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=100, help='Median latency of every call.')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='Spread of the lognormal latency.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of calls answered with 503.')
+    parser.add_argument('--decline-rate', type=float, default=0.0, help='Share of authorizations declined.')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='Share of calls that hang, then 504.')
+    parser.add_argument('--timeout-seconds', type=float, default=30, help='How long a hanging call hangs.')
+    parser.add_argument('--quiet', action='store_true', help='Do not log every request.')
+    options = parser.parse_args()
+
+    server = ThreadingHTTPServer((options.host, options.port), GatewayHandler)
+    server.daemon_threads = True
+    server.gateway = Gateway(options)
+    server.quiet = options.quiet
+    print(f'Payment gateway simulator on http://{options.host}:{options.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
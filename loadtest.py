@@ -0,0 +1,169 @@
+# Load test for the payment flows. Each simulated resident opens the card or e-wallet form,
+# submits it and polls the payment intent until it settles, and the script reports throughput
+# and latency percentiles for the submit response and for the whole payment. Start the
+# gateway simulator and the app against the same database first:
+#   python gateway_sim.py --quiet --latency-ms 150 --error-rate 0.02
+#   FLASK_PAYMENT_GATEWAY=http://127.0.0.1:8081 flask run --port 5000
+#   python loadtest.py --concurrency 20 --payments 500 --flow mixed
+# The residents (loadtest-001, ...) and their sessions are written straight into the database,
+# so the test does not pay for password hashing or run into the login rate limits. Every
+# payment first gets a fee row of its own, so there is always a balance to pay.
+import argparse
+import itertools
+import re
+import secrets
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import Payment, User, app, db, hash_password, session_store
+
+FEE = Decimal('25.00')
+
+
+# Create the load test residents if needed, each with a logged in session
+def prepare_residents(count):
+    password = hash_password(secrets.token_urlsafe(16))
+    expires_at = datetime.now() + timedelta(hours=2)
+    residents = []
+    with app.app_context():
+        for number in range(1, count + 1):
+            name = f'loadtest-{number:03d}'
+            db.session.execute(sqlite_insert(User.__table__).values(
+                name=name, email=f'{name}@example.com', password=password, unit_number=f'LT-{number:03d}',
+            ).on_conflict_do_nothing())
+            user_id = db.session.execute(select(User.id).where(User.name == name)).scalar_one()
+            db.session.commit()
+            sid = secrets.token_urlsafe(32)
+            session_store.save(sid, user_id, app.session_interface.serializer.dumps({'user_id': user_id}), expires_at)
+            residents.append((user_id, name, sid))
+    return residents
+
+
+def charge_fee(user_id, name):
+    with app.app_context():
+        db.session.execute(insert(Payment.__table__).values(
+            user_id=user_id, name=name, payment_method='Invoice', amount_cents=FEE, payment_date=date.today()))
+        db.session.commit()
+
+
+class Client:
+    def __init__(self, base_url, sid, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cookie = f"{app.session_interface.get_cookie_name(app)}={sid}"
+
+    def request(self, path, form=None):
+        data = urllib.parse.urlencode(form).encode() if form is not None else None
+        http_request = urllib.request.Request(self.base_url + path, data=data, headers={'Cookie': self.cookie})
+        try:
+            with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read().decode()
+
+
+FLOWS = {
+    'card': ('/onlinebanking', '/submit', lambda number: {
+        'card_number': '4242 4242 4242 4242', 'cvc': '123', 'expiration_month': '12',
+        'expiration_year': str(date.today().year % 100 + 3)}),
+    'ewallet': ('/ewalletoption', '/ewallet_submit', lambda number: {
+        'wallet': ('tng', 'grabpay', 'boost', 'shopeepay')[number % 4]}),
+}
+
+
+# Pay once through one flow, returning (outcome, submit seconds, end to end seconds)
+def pay(client, flow, number, poll_interval, settle_timeout):
+    form_path, submit_path, fields = FLOWS[flow]
+    status, page = client.request(form_path)
+    match = re.search(r'name="idempotency_key" value="([^"]+)"', page)
+    if status != 200 or match is None:
+        return f'form {status}', None, None
+    idempotency_key = match.group(1)
+
+    started = time.perf_counter()
+    status, _ = client.request(submit_path, {'idempotency_key': idempotency_key, **fields(number)})
+    submitted = time.perf_counter() - started
+    if status not in (200, 202):
+        return f'submit {status}', submitted, None
+
+    deadline = started + settle_timeout
+    while time.perf_counter() < deadline:
+        status, body = client.request(f'/api/payment_intents/{idempotency_key}')
+        outcome = re.search(r'"status":\s*"(\w+)"', body)
+        if status == 200 and outcome and outcome.group(1) in ('succeeded', 'failed'):
+            return outcome.group(1), submitted, time.perf_counter() - started
+        time.sleep(poll_interval)
+    return 'unsettled', submitted, None
+
+
+def percentiles(samples):
+    if len(samples) < 2:
+        return 'n/a'
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return ', '.join(f'p{p} {cuts[p - 1] * 1000:.0f} ms' for p in (50, 95, 99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the card and e-wallet payment flows.')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=10, help='Residents paying at the same time.')
+    parser.add_argument('--payments', type=int, default=200, help='Total payments to make.')
+    parser.add_argument('--flow', choices=('card', 'ewallet', 'mixed'), default='mixed')
+    parser.add_argument('--poll-interval', type=float, default=0.2)
+    parser.add_argument('--settle-timeout', type=float, default=60, help='Give up on a payment after this long.')
+    parser.add_argument('--timeout', type=float, default=30, help='Timeout of each HTTP request.')
+    options = parser.parse_args()
+
+    # One resident per thread, so no two payments ever race for the same balance
+    residents = prepare_residents(options.concurrency)
+    numbers = itertools.count()
+    numbers_lock = threading.Lock()
+    results = []
+    results_lock = threading.Lock()
+
+    def run_resident(user_id, name, sid):
+        client = Client(options.base_url, sid, options.timeout)
+        while True:
+            with numbers_lock:
+                number = next(numbers)
+            if number >= options.payments:
+                return
+            flow = options.flow if options.flow != 'mixed' else ('card', 'ewallet')[number % 2]
+            charge_fee(user_id, name)
+            try:
+                result = pay(client, flow, number, options.poll_interval, options.settle_timeout)
+            except OSError as error:
+                result = (type(error).__name__, None, None)
+            with results_lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=run_resident, args=resident) for resident in residents]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    outcomes = {}
+    for outcome, _, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    settled = [total for outcome, _, total in results if total is not None]
+    print(f'{len(results)} payments with {options.concurrency} residents in {elapsed:.1f} s, '
+          f'{len(settled) / elapsed:.1f} settled payments/s')
+    print('Outcomes:', ', '.join(f'{outcome} {count}' for outcome, count in sorted(outcomes.items())))
+    print('Submit response:', percentiles([submitted for _, submitted, _ in results if submitted is not None]))
+    print('End to end:', percentiles(settled))
+
+
+if __name__ == '__main__':
+    main()
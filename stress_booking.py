@@ -0,0 +1,109 @@
+# Stress test for the booking engine. Thousands of residents book the same few slots at once
+# through the Flask test client from many threads, then the script checks that no slot ended
+# up over its capacity, that every slot with more demand than places is exactly full and that
+# the occupancy rollup agrees with the reservations. It runs on a fresh database in a
+# temporary directory, so it can be started from a checkout without touching users.db:
+#   python stress_booking.py --bookings 3000 --threads 50
+# The exit status is 1 when any check fails.
+import argparse
+import os
+import random
+import secrets
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+# Settings are read from the environment when app is imported, point it at a scratch database
+scratch = tempfile.mkdtemp(prefix='stress-booking-')
+os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(scratch, 'users.db')
+os.environ['FLASK_RATE_LIMIT_DB'] = os.path.join(scratch, 'ratelimit.db')
+
+from sqlalchemy import func, insert, select
+
+from app import (SLOT_END_MINUTE, OccupancyDaily, Reservation, SlotCapacity, User, app, db, hash_password,
+                 session_store)
+
+
+# Residents of their own units (so the weekly quota never refuses them), each signed in
+def prepare_residents(count):
+    password = hash_password(secrets.token_urlsafe(16))
+    expires_at = datetime.now() + timedelta(hours=2)
+    db.session.execute(insert(User), [
+        {'name': f'stress-{number:05d}', 'email': f'stress-{number:05d}@example.com', 'password': password,
+         'unit_number': f'S-{number:05d}'} for number in range(count)])
+    db.session.commit()
+    sessions = []
+    for user_id in db.session.execute(select(User.id)).scalars():
+        sid = secrets.token_urlsafe(32)
+        session_store.save(sid, user_id, app.session_interface.serializer.dumps({'user_id': user_id}), expires_at)
+        sessions.append(sid)
+    return sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fire concurrent bookings and check no slot is overbooked.')
+    parser.add_argument('--bookings', type=int, default=3000, help='Residents booking, one booking each.')
+    parser.add_argument('--threads', type=int, default=50, help='Bookings submitted at the same time.')
+    parser.add_argument('--days-ahead', type=int, default=7, help='How far ahead the booked day is.')
+    options = parser.parse_args()
+
+    day = date.today() + timedelta(days=options.days_ahead)
+    slots = [(location, start_minute) for location in app.config['FACILITY_CAPACITY'] for start_minute in SLOT_END_MINUTE]
+    with app.app_context():
+        # One slot gets a capacity override, the engine has to honour it like the default
+        override = SlotCapacity(location=slots[0][0], selected_date=day, start_minute=slots[0][1], capacity=3)
+        db.session.add(override)
+        db.session.commit()
+        capacities = {slot: app.config['FACILITY_CAPACITY'][slot[0]] for slot in slots}
+        capacities[slots[0]] = override.capacity
+        sessions = prepare_residents(options.bookings)
+
+    cookie_name = app.session_interface.get_cookie_name(app)
+    wanted = [random.choice(slots) for _ in sessions]
+
+    def book(sid, slot):
+        client = app.test_client()
+        client.set_cookie(cookie_name, sid)
+        response = client.post('/process_selection', data={
+            'activity': slot[0], 'selected_date': day.strftime('%Y-%m-%d'), 'start_minute': slot[1]})
+        return response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.threads) as pool:
+        statuses = Counter(pool.map(book, sessions, wanted))
+    elapsed = time.perf_counter() - started
+    print(f'{options.bookings} bookings from {options.threads} threads in {elapsed:.1f} s '
+          f'({options.bookings / elapsed:.0f}/s), responses: {dict(statuses)}')
+
+    failures = []
+    if set(statuses) != {302}:
+        failures.append(f'expected only redirects, got {dict(statuses)}')
+    demand = Counter(wanted)
+    with app.app_context():
+        booked = dict(((row.location, row.start_minute), row.count) for row in db.session.execute(
+            select(Reservation.location, Reservation.start_minute, func.count().label('count'))
+            .where(Reservation.selected_date == day).group_by(Reservation.location, Reservation.start_minute)))
+        rollup = dict(((row.location, row.start_minute), row.booked) for row in db.session.execute(
+            select(OccupancyDaily.location, OccupancyDaily.start_minute, OccupancyDaily.booked)
+            .where(OccupancyDaily.day == day)))
+    for slot in slots:
+        count = booked.get(slot, 0)
+        print(f'{slot[0]} {slot[1]}: demand {demand[slot]}, capacity {capacities[slot]}, booked {count}')
+        if count > capacities[slot]:
+            failures.append(f'{slot} is overbooked: {count} of {capacities[slot]}')
+        if count != min(demand[slot], capacities[slot]):
+            failures.append(f'{slot} should have {min(demand[slot], capacities[slot])} bookings, has {count}')
+        if rollup.get(slot, 0) != count:
+            failures.append(f'{slot} rollup says {rollup.get(slot, 0)}, reservations say {count}')
+
+    for failure in failures:
+        print('FAIL', failure)
+    print('OK' if not failures else f'{len(failures)} checks failed')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()